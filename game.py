@@ -4,9 +4,32 @@ import time
 import json
 import random
 import copy
+import threading
+import collections
+import asyncio
+import argparse
+import tempfile
+import functools
+import array
+import struct
+import zlib
+import bisect
+import importlib
+import itertools
+import math
+import concurrent.futures
+
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 
 import pygame
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 COLOR_WHITE = (255, 255, 255)
 COLOR_BLUE = (0, 0, 255)
 COLOR_BLACK = (0, 0, 0)
@@ -24,23 +47,130 @@ BOARD_WIDTH = 300
 BOARD_HEIGHT = 460
 BOARD_GEOMETRY = (BOARD_X, BOARD_Y, BOARD_WIDTH, BOARD_HEIGHT)
 BOX_SIZE = 20
+BOARD_ROWS = BOARD_HEIGHT // BOX_SIZE
+BOARD_COLS = BOARD_WIDTH // BOX_SIZE
+BOARD_MAX_ROWS = 1000
+BOARD_MAX_COLS = 200
+MIN_BOX_SIZE = 4
+CAMERA_SPEED = 6.0
+COLOR_FLASH = (255, 255, 255)
+LINE_FLASH_TIME = 0.2
+LINE_BLINK_TIME = 0.05
+LINE_COLLAPSE_TIME = 0.15
+LOCK_FLASH_TIME = 0.15
+ANIMATION_SLOTS = 16
+ANIMATION_MAX_ROWS = 5
+ANIMATION_MAX_CELLS = 8
+ANIMATION_CLEAR = 1
+ANIMATION_LOCK = 2
 
 COLOR_SMALL_BLOCK = (255, 120, 115)
-COLOR_LONG_BLOCK = (255, 200, 105)
 COLOR_STATIC_BOX = (200, 200, 50)
-COLOR_BIG_BLOCK = (200, 200, 250)
 COLOR_BG_GAME_OVER = (30, 30, 30)
 COLOR_BLOCK_GAME_OVER = (200, 200, 200)
-COLOR_T_BLOCK = (170, 170, 0)
-COLOR_L_BLOCK = (200, 100, 30)
-COLOR_S_BLOCK = (250, 250, 100)
-COLOR_Z_BLOCK = (100, 250, 200)
 PLAYER_SPEED = 380
+PIECES_FILE = './pieces.json'
+
+TARGET_FPS = 60
+VSYNC = False
+FPS_REPORT_INTERVAL = 5.0
+FRAME_SPIN_TIME = 0.001
+SIMULATION_THREAD = False
+SIMULATION_TICK_RATE = 120
 
 EVENT_FULL_LINES = 'FULL_LINES'
+AI_WEIGHTS = {
+    'height': -0.510066,
+    'lines': 0.760666,
+    'holes': -0.35663,
+    'bumpiness': -0.184483,
+}
+AI_CACHE_SIZE = 50000
+REWIND_CAPACITY = 256
+REPLAY_FILE = 'replay.tetr'
+REPLAY_KEYFRAME_INTERVAL = 10
+REPLAY_MAGIC = b'TTRP'
+REPLAY_INDEX_MAGIC = b'TTRX'
+REPLAY_VERSION = 3
+REPLAY_INPUT_CODES = {
+    'LEFT': 1, 'RIGHT': 2, 'STOP': 3, 'DOWN': 4, 'ROTATE': 5, 'DROP': 6,
+    'PAUSE': 7, 'REWIND': 8, 'SHIFT_LEFT': 9, 'SHIFT_RIGHT': 10,
+}
+PIECE_STORE_FILE = 'pieces.bin'
+PIECE_STORE_MAGIC = b'TTPC'
+PIECE_STORE_VERSION = 2
+PIECE_STORE_CHUNK = 65536
+PIECE_FLUSH_RECORDS = 64
+ENV_ACTIONS = ('NOOP', 'LEFT', 'RIGHT', 'ROTATE', 'DROP')
+ENV_STEP_TIME = 0.05
+ENV_CELL_EMPTY = 0
+ENV_CELL_STATIC = 1
+ENV_CELL_BLOCK = 2
+PLAYER_KEYS = (
+    {'K_LEFT': 'LEFT', 'K_RIGHT': 'RIGHT', 'K_UP': 'DROP', 'K_DOWN': 'ROTATE'},
+    {'K_a': 'LEFT', 'K_d': 'RIGHT', 'K_w': 'DROP', 'K_s': 'ROTATE'},
+    {'K_j': 'LEFT', 'K_l': 'RIGHT', 'K_i': 'DROP', 'K_k': 'ROTATE'},
+    {'K_KP4': 'LEFT', 'K_KP6': 'RIGHT', 'K_KP8': 'DROP', 'K_KP5': 'ROTATE'},
+)
+PLAYER_WIDTH = WINDOW_WIDTH
+FEED_NAME = 'tetris_live'
+FEED_MAGIC = b'TTLF'
+FEED_VERSION = 2
+FEED_MAX_BOXES = 8
+FEED_READ_RETRIES = 100
+TOURNAMENT_SEEDS = 4
+TOURNAMENT_MAX_PIECES = 200
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 7777
+SERVER_TICK_RATE = 60
+SERVER_MAX_BUFFER = 64 * 1024
+MESSAGE_FULL = 1
+MESSAGE_DELTA = 2
+MESSAGE_INPUT = 3
 SOUNDS_DIR = './sounds'
 SETTING_FILE = 'settings.json'
 GAME_STATE_FILE = 'save.json'
+AUTOSAVE_FILE = 'autosave.json'
+AUTOSAVE_INTERVAL = 0
+SETTINGS_DEBOUNCE = 1.0
+SETTINGS_DEFAULTS = {
+    'mute': False,
+    'vsync': VSYNC,
+    'target_fps': TARGET_FPS,
+    'fps_report': False,
+    'simulation_thread': SIMULATION_THREAD,
+    'simulation_tick_rate': SIMULATION_TICK_RATE,
+    'autosave_interval': AUTOSAVE_INTERVAL,
+    'font_path': '',
+    'audio_frequency': 44100,
+    'audio_buffer': 512,
+    'live_feed': False,
+    'display_mode': 'window',
+    'smooth_scale': False,
+    'animations': True,
+}
+BG_MUSIC_FILE = 'bg.wav'
+HOT_SOUNDS = ('rotate', 'stop', 'line')
+SOUND_CACHE_BYTES = 8 * 1024 * 1024
+SOUND_CATEGORIES = {'rotate': 'move', 'stop': 'lock', 'line': 'line'}
+RESERVED_CHANNELS = {'move': 2, 'lock': 2, 'line': 1}
+SHARED_CHANNELS = 3
+SOUND_PRIORITIES = {'rotate': 1, 'stop': 2, 'line': 3}
+SOUND_MIN_INTERVALS = {'rotate': 0.06, 'stop': 0.03}
+FONT_NAME = 'monospace'
+FONT_SIZE = 15
+TEXT_CACHE_SIZE = 256
+DISPLAY_MODES = ('window', 'resizable', 'fullscreen')
+SETTINGS_RANGES = {
+    'target_fps': (0, 1000),
+    'simulation_tick_rate': (1, 1000),
+    'autosave_interval': (0, 24 * 3600),
+    'audio_frequency': (8000, 192000),
+    'audio_buffer': (64, 16384),
+}
+SETTINGS_CHOICES = {
+    'display_mode': DISPLAY_MODES,
+}
 
 
 def get_gravity(level):
@@ -62,6 +192,10 @@ class EventEmitter:
             self.listeners[event] = []
         self.listeners[event].append(listener)
 
+    def remove_listener(self, event, listener):
+        if event in self.listeners and listener in self.listeners[event]:
+            self.listeners[event].remove(listener)
+
     def emit(self, event, *args, **kwargs):
         if event in self.listeners:
             for listener in self.listeners[event]:
@@ -95,6 +229,21 @@ class Activity:
     def add_listener(self, event, listener):
         pass
 
+    def add_sound_listener(self, listener):
+        pass
+
+    def add_exit_listener(self, listener):
+        pass
+
+    def add_save_listener(self, listener):
+        pass
+
+    def add_load_listener(self, listener):
+        pass
+
+    def add_toggle_mute_listener(self, listener):
+        pass
+
     def prepare(self):
         pass
 
@@ -126,13 +275,36 @@ class Activity:
     def set_state(self, state):
         pass
 
+    def enable_snapshots(self):
+        pass
+
+    def enable_animations(self):
+        pass
+
+    def enable_feed(self, feed):
+        pass
+
+    def get_board_shape(self):
+        return BOARD_ROWS, BOARD_COLS
+
+    def has_state(self):
+        return False
+
+    def take_piece_records(self):
+        return b''
+
 
 class TetrisActivity(Activity):
 
-    def __init__(self):
+    def __init__(self, autoplay=False, rows=None, cols=None,
+                 pieces_file=None):
         super().__init__()
         self.level_activity = LevelActivity()
         self.play_activity = PlayActivity()
+        self.play_activity.autoplay = autoplay
+        self.play_activity.rows = rows
+        self.play_activity.cols = cols
+        self.play_activity.pieces_file = pieces_file
         self.menu_activity = MenuActivity()
         self.curr_activity = self.level_activity
 
@@ -167,6 +339,8 @@ class TetrisActivity(Activity):
     def run_game(self, level):
         self.curr_activity = self.play_activity
         self.play_activity.level = level
+        if self.play_activity.recorder is not None:
+            self.play_activity.recorder.level = level
 
     def on_mouse(self, x, y):
         self.curr_activity.on_mouse(x, y)
@@ -200,10 +374,109 @@ class TetrisActivity(Activity):
     def set_state(self, state):
         self.play_activity.set_state(state['play'])
 
+    def enable_snapshots(self):
+        self.play_activity.enable_snapshots()
+
+    def enable_animations(self):
+        self.play_activity.enable_animations()
+
+    def enable_feed(self, feed):
+        self.play_activity.enable_feed(feed)
+
+    def get_board_shape(self):
+        return self.play_activity.get_board_shape()
+
+    def has_state(self):
+        return self.play_activity.has_state()
+
+    def take_piece_records(self):
+        return self.play_activity.take_piece_records()
+
     def resume_game(self):
         self.curr_activity = self.play_activity
 
 
+class SplitScreenActivity(Activity):
+    supported_events = ('PAUSE', 'UNPAUSE')
+
+    def __init__(self, player_count, level=1, seed=None, rows=None,
+                 cols=None, pieces_file=None):
+        super().__init__()
+        self.player_count = player_count
+        self.level = level
+        self.seed = seed
+        self.rows = rows
+        self.cols = cols
+        self.pieces_file = pieces_file
+        self.players = []
+        self.paused = False
+        self.event_emitter = EventEmitter()
+
+    def prepare(self):
+        # Wspólne ziarno daje wszystkim graczom tę samą kolejkę klocków,
+        # ale każda plansza losuje własnym generatorem.
+        if self.seed is None:
+            self.seed = random.randrange(1 << 32)
+        for index in range(self.player_count):
+            keys = dict(
+                (getattr(pygame, name), action)
+                for name, action in PLAYER_KEYS[index].items())
+            player = PlayActivity(index * PLAYER_WIDTH, keys)
+            player.level = self.level
+            player.seed = self.seed
+            player.rows = self.rows
+            player.cols = self.cols
+            player.pieces_file = self.pieces_file
+            player.recording = False
+            player.prepare()
+            self.players.append(player)
+
+    def add_listener(self, event, listener):
+        self.event_emitter.add_listener(event, listener)
+
+    def add_sound_listener(self, listener):
+        for player in self.players:
+            player.add_sound_listener(listener)
+
+    def add_exit_listener(self, listener):
+        self.event_emitter.add_listener('EXIT', listener)
+
+    def on_keydown(self, key):
+        if key == pygame.K_ESCAPE:
+            self.event_emitter.emit('EXIT')
+        elif key == pygame.K_p:
+            self.toggle_pause()
+        else:
+            for player in self.players:
+                player.on_keydown(key)
+
+    def on_keyup(self, key):
+        for player in self.players:
+            player.on_keyup(key)
+
+    def toggle_pause(self):
+        self.paused = not self.paused
+        for player in self.players:
+            player.board.toggle_pause()
+        self.event_emitter.emit('PAUSE' if self.paused else 'UNPAUSE')
+
+    def update(self, delta_time):
+        for player in self.players:
+            player.update(delta_time)
+
+    def render(self, painter):
+        for player in self.players:
+            player.render(painter)
+
+    def enable_snapshots(self):
+        for player in self.players:
+            player.enable_snapshots()
+
+    def enable_animations(self):
+        for player in self.players:
+            player.enable_animations()
+
+
 class LevelActivity(Activity):
 
     def __init__(self):
@@ -313,10 +586,12 @@ class ButtonItem(Item):
 
 
 class PlayActivity(Activity):
-    supported_events = ('PAUSE', 'UNPAUSE')
+    supported_events = ('PAUSE', 'UNPAUSE', 'REPLAY', 'PIECES')
 
-    def __init__(self):
+    def __init__(self, x=0, keys=None):
         super().__init__()
+        self.x = x
+        self.keys = keys
         self.items = []
         self.board = None
         self.level_label = None
@@ -325,31 +600,62 @@ class PlayActivity(Activity):
         self.scores = 0
         self.lines = 0
         self.level = 1
+        self.autoplay = False
+        self.autoplayer = None
+        self.rewind_buffer = RewindBuffer()
+        self.recording = True
+        self.recorder = None
+        self.resume_recording = False
+        self.piece_recorder = None
+        self.feed = None
+        self.seed = None
+        self.rows = None
+        self.cols = None
+        self.pieces_file = None
 
     def prepare(self):
-        self.board = create_board(lambda: self.level)
+        if self.seed is None:
+            self.seed = random.randrange(1 << 32)
+        self.board = create_board(
+            lambda: self.level, self.seed,
+            (BOARD_X + self.x, BOARD_Y, BOARD_WIDTH, BOARD_HEIGHT),
+            self.pieces_file, self.rows, self.cols)
+        if self.recording:
+            self.start_piece_recorder()
+        if self.autoplay:
+            self.toggle_autoplay()
         self.board.add_listener(EVENT_FULL_LINES, self.on_full_lines)
         self.board.add_sound_listener(
             lambda s: self.event_emitter.emit('SOUND', s))
         self.board.add_game_over_listener(self.on_game_over)
+        self.board.add_lock_listener(self.on_lock)
         self.items.append(self.board)
+        # Pierwsza migawka musi znać następny klocek, inaczej cofnięcie
+        # przed położeniem klocka zostawi planszę bez podglądu.
+        self.board.get_next_block()
+        self.rewind_buffer.push(self.take_snapshot())
+        if self.recording:
+            self.start_recorder()
 
         self.level_label = NumberLabel(
-            10, 10, COLOR_BLACK, 'POZIOM', lambda: self.level)
+            self.x + 10, 10, COLOR_BLACK, 'POZIOM',
+            lambda: self.get_counters()[0])
         self.items.append(self.level_label)
 
         self.scores_label = NumberLabel(
-            10, 30, COLOR_BLACK, 'PUNKTY', lambda: self.scores)
+            self.x + 10, 30, COLOR_BLACK, 'PUNKTY',
+            lambda: self.get_counters()[1])
         self.items.append(self.scores_label)
 
-        self.next_block_label = Label(430, 10, COLOR_BLACK, 'KLOCEK')
+        self.next_block_label = Label(
+            self.x + 430, 10, COLOR_BLACK, 'KLOCEK')
         self.items.append(self.next_block_label)
 
         self.next_block_view = NextBlockView(
-            430, 50, lambda: self.board.next_block)
+            self.x + 430, 50, self.get_next_cells)
         self.items.append(self.next_block_view)
 
-        self.game_over_label = Label(220, 10, COLOR_RED, '')
+        self.game_over_label = Label(self.x + 220, 10, COLOR_RED, '')
         self.items.append(self.game_over_label)
 
     def add_listener(self, event, listener):
@@ -359,23 +665,47 @@ class PlayActivity(Activity):
         self.event_emitter.add_listener('SOUND', listener)
 
     def update(self, delta_time):
+        if self.resume_recording and self.board.curr_block is None:
+            self.resume_recording = False
+            if not self.board.game_over:
+                self.start_recorder()
+        if self.autoplayer is not None:
+            self.autoplayer.update(delta_time)
         for item in self.items:
             item.update(delta_time)
+        if self.feed is not None:
+            self.feed.publish(self.board, self.scores, self.lines, self.level)
 
     def get_items(self):
         return self.items
 
+    def toggle_autoplay(self):
+        if self.autoplayer is None:
+            self.autoplayer = AutoPlayer(self.board)
+        else:
+            self.autoplayer = None
+            self.board.set_direction(None)
+
     def on_keyup(self, key):
-        self.board.set_direction(None)
+        if self.keys is None or self.keys.get(key) in ('LEFT', 'RIGHT'):
+            self.board.set_direction(None)
 
     def on_keydown(self, key):
-        if pygame.K_LEFT == key:
+        if self.keys is not None:
+            self.on_player_key(self.keys.get(key))
+        elif pygame.K_LEFT == key:
             self.board.set_direction('LEFT')
         elif pygame.K_RIGHT == key:
             self.board.set_direction('RIGHT')
         # Po odkomentowaniu zadziała szybsze opadanie
         # elif pygame.K_DOWN == key:
         #     self.board.set_direction('DOWN')
+        elif pygame.K_UP == key:
+            self.board.drop_curr_block()
+        elif pygame.K_a == key:
+            self.toggle_autoplay()
+        elif pygame.K_BACKSPACE == key:
+            self.rewind()
         elif pygame.K_SPACE == key:
             self.board.rotate_curr_block()
         elif pygame.K_p == key:
@@ -385,6 +715,14 @@ class PlayActivity(Activity):
             else:
                 self.event_emitter.emit('UNPAUSE')
 
+    def on_player_key(self, action):
+        if action == 'LEFT' or action == 'RIGHT':
+            self.board.set_direction(action)
+        elif action == 'DROP':
+            self.board.drop_curr_block()
+        elif action == 'ROTATE':
+            self.board.rotate_curr_block()
+
     def on_click(self, x, y):
         pass
 
@@ -394,6 +732,40 @@ class PlayActivity(Activity):
 
     def on_game_over(self):
         self.show_game_over()
+        if self.recorder is not None:
+            self.event_emitter.emit('REPLAY', self.recorder.to_bytes())
+
+    def on_lock(self):
+        self.rewind_buffer.push(self.take_snapshot())
+        recorder = self.piece_recorder
+        # Zapis co kilkadziesiąt klocków, żeby wyjście bez końca gry
+        # nie gubiło całej partii.
+        if recorder is not None and (
+                recorder.game_over or
+                recorder.record_count() >= PIECE_FLUSH_RECORDS):
+            self.event_emitter.emit('PIECES', recorder.take_records())
+
+    def start_recorder(self):
+        self.recorder = ReplayRecorder(
+            self.board, self.seed, self.level,
+            lambda: (self.scores, self.lines))
+
+    def start_piece_recorder(self):
+        self.piece_recorder = PieceRecorder(
+            self.board, random.getrandbits(64),
+            lambda: (self.scores, self.lines))
+
+    def take_snapshot(self):
+        return self.board.take_compact_snapshot(self.scores, self.lines)
+
+    def rewind(self):
+        snapshot = self.rewind_buffer.step_back()
+        if snapshot is None:
+            return
+        self.board.restore_compact_snapshot(snapshot)
+        self.scores = snapshot.scores
+        self.lines = snapshot.lines
+        self.clear_game_over()
 
     def show_game_over(self):
         self.game_over_label.label = 'GAME OVER'
@@ -419,6 +791,53 @@ class PlayActivity(Activity):
             self.show_game_over()
         else:
             self.clear_game_over()
+        self.rewind_buffer.clear()
+        if self.recorder is not None:
+            # Migawka nie zapisuje spadającego klocka, więc nowa powtórka
+            # zaczyna się od chwili, gdy wczytany klocek się położy.
+            self.recorder.stop()
+            self.recorder = None
+            self.resume_recording = True
+        if self.piece_recorder is not None:
+            # Wczytana gra to nowa partia w magazynie klocków.
+            self.piece_recorder.stop()
+            records = self.piece_recorder.take_records()
+            if records:
+                self.event_emitter.emit('PIECES', records)
+            self.start_piece_recorder()
+
+    def enable_snapshots(self):
+        self.board.enable_snapshots(lambda: (self.level, self.scores))
+
+    def get_counters(self):
+        # Z wątkiem symulacji widżety czytają tylko z migawki planszy.
+        snapshot = self.board.read_snapshot()
+        if snapshot is None:
+            return self.level, self.scores
+        return snapshot.counters
+
+    def get_next_cells(self):
+        snapshot = self.board.read_snapshot()
+        if snapshot is None:
+            return self.board.get_next_cells()
+        return snapshot.next_cells
+
+    def enable_animations(self):
+        self.board.enable_animations()
+
+    def enable_feed(self, feed):
+        self.feed = feed
+
+    def get_board_shape(self):
+        return self.board.block_end_row, self.board.block_end_col
+
+    def has_state(self):
+        return self.board.next_block is not None
+
+    def take_piece_records(self):
+        if self.piece_recorder is None:
+            return b''
+        return self.piece_recorder.take_records()
 
 
 
@@ -524,7 +943,17 @@ class Painter:
         self.height = height
         self.background_color = COLOR_WHITE
         self.screen = None
+        self.display = None
+        self.display_mode = 'window'
+        self.smooth_scale = False
+        self.scaled = None
+        self.scaled_pos = (0, 0)
+        self.borders = []
+        self.scale = 1.0
+        self.vsync = False
         self.font = None
+        self.font_path = None
+        self.text_cache = {}
 
     def fill_rect(self, x, y, w, h, color):
         pygame.draw.rect(self.screen, color, [x, y, w, h])
@@ -536,85 +965,678 @@ class Painter:
         pygame.draw.line(self.screen, color, (x1, y1), (x2, y2))
 
     def draw_text(self, x, y, text, color):
-        label = self.font.render(text, 1, color)
+        key = (text, color)
+        label = self.text_cache.get(key)
+        if label is None:
+            if len(self.text_cache) >= TEXT_CACHE_SIZE:
+                self.text_cache.clear()
+            label = self.text_cache[key] = self.font.render(text, 1, color)
         self.screen.blit(label, (x, y))
 
-    def run(self):
+    def run(self, vsync=False, font_path=None, display_mode='window',
+            smooth_scale=False):
         pygame.font.init()
-        self.screen = pygame.display.set_mode((self.width, self.height))
-        self.font = pygame.font.SysFont("monospace", 15)
+        self.display_mode = display_mode
+        self.smooth_scale = smooth_scale
+        self.vsync = vsync
+        self.display = self.create_screen(vsync)
+        if display_mode == 'window':
+            self.screen = self.display
+        else:
+            # Gra rysuje zawsze w rozdzielczości logicznej, a gotowa
+            # klatka jest raz skalowana do rozmiaru ekranu.
+            self.screen = pygame.Surface((self.width, self.height)).convert()
+            self.update_scale()
+        self.font = self.load_font(font_path)
+
+    def load_font(self, font_path):
+        if not font_path or not os.path.exists(font_path):
+            font_path = pygame.font.match_font(FONT_NAME)
+        self.font_path = font_path
+        return pygame.font.Font(font_path, FONT_SIZE)
+
+    def create_screen(self, vsync):
+        size = (self.width, self.height)
+        flags = 0
+        if self.display_mode == 'fullscreen':
+            size = (0, 0)
+            flags = pygame.FULLSCREEN
+        elif self.display_mode == 'resizable':
+            flags = pygame.RESIZABLE
+        if vsync:
+            try:
+                return pygame.display.set_mode(
+                    size, flags or pygame.SCALED, vsync=1)
+            except (pygame.error, TypeError, AttributeError):
+                print('VSYNC NIEDOSTĘPNY')
+        return pygame.display.set_mode(size, flags)
+
+    def update_scale(self):
+        # Skala, docelowa powierzchnia i pozycja obrazu liczone są tylko
+        # przy zmianie rozmiaru okna.
+        display_w, display_h = self.display.get_size()
+        scale = min(display_w / self.width, display_h / self.height)
+        if scale >= 1 and not self.smooth_scale:
+            scale = int(scale)
+        self.scale = scale
+        size = (max(int(self.width * scale), 1),
+                max(int(self.height * scale), 1))
+        if size == (self.width, self.height):
+            self.scaled = None
+        else:
+            self.scaled = pygame.Surface(size).convert()
+        x = (display_w - size[0]) // 2
+        y = (display_h - size[1]) // 2
+        self.scaled_pos = (x, y)
+        self.borders = [
+            rect for rect in (
+                (0, 0, display_w, y),
+                (0, y + size[1], display_w, display_h - y - size[1]),
+                (0, y, x, size[1]),
+                (x + size[0], y, display_w - x - size[0], size[1]))
+            if rect[2] > 0 and rect[3] > 0]
+
+    def resize(self, width, height):
+        if self.display_mode != 'resizable':
+            return
+        self.display = pygame.display.get_surface()
+        if self.display.get_size() != (width, height):
+            self.display = pygame.display.set_mode(
+                (width, height), pygame.RESIZABLE)
+        self.update_scale()
+
+    def toggle_fullscreen(self):
+        if self.display_mode == 'window':
+            return
+        if self.display_mode == 'fullscreen':
+            self.display_mode = 'resizable'
+        else:
+            self.display_mode = 'fullscreen'
+        self.display = self.create_screen(self.vsync)
+        self.update_scale()
+
+    def present(self):
+        if self.screen is not self.display:
+            for rect in self.borders:
+                self.display.fill(COLOR_BLACK, rect)
+            if self.scaled is None:
+                self.display.blit(self.screen, self.scaled_pos)
+            else:
+                if self.smooth_scale:
+                    pygame.transform.smoothscale(
+                        self.screen, self.scaled.get_size(), self.scaled)
+                else:
+                    pygame.transform.scale(
+                        self.screen, self.scaled.get_size(), self.scaled)
+                self.display.blit(self.scaled, self.scaled_pos)
+        pygame.display.update()
+
+    def to_logical(self, x, y):
+        return (int((x - self.scaled_pos[0]) / self.scale),
+                int((y - self.scaled_pos[1]) / self.scale))
 
     def render_background(self):
         self.screen.fill(self.background_color)
 
+    def blit(self, surface, x, y, area=None):
+        self.screen.blit(surface, (x, y), area)
+
+    def set_clip(self, x, y, w, h):
+        self.screen.set_clip(pygame.Rect(x, y, w, h))
+
+    def reset_clip(self):
+        self.screen.set_clip(None)
+
+    def create_layer(self, x, y, width, height):
+        return Layer(self, x, y, width, height)
+
+
+class Layer(Painter):
+
+    def __init__(self, painter, x, y, width, height):
+        super().__init__(width, height)
+        self.x = x
+        self.y = y
+        self.font = painter.font
+        self.screen = pygame.Surface((width, height)).convert()
+
+    def fill_rect(self, x, y, w, h, color):
+        super().fill_rect(x - self.x, y - self.y, w, h, color)
+
+    def draw_rect(self, x, y, w, h, color):
+        super().draw_rect(x - self.x, y - self.y, w, h, color)
+
+    def draw_line(self, x1, y1, x2, y2, color):
+        super().draw_line(
+            x1 - self.x, y1 - self.y, x2 - self.x, y2 - self.y, color)
+
+    def draw_text(self, x, y, text, color):
+        super().draw_text(x - self.x, y - self.y, text, color)
+
+    def render(self, painter, area=None):
+        painter.blit(self.screen, self.x, self.y, area)
+
+
+class SoundCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, sound, size):
+        if key in self.entries:
+            self.used_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (sound, size)
+        self.used_bytes += size
+        while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.used_bytes -= evicted_size
+
+
+class ChannelManager:
+
+    def __init__(self, categories=SOUND_CATEGORIES,
+                 reserved=RESERVED_CHANNELS, shared=SHARED_CHANNELS,
+                 priorities=SOUND_PRIORITIES,
+                 min_intervals=SOUND_MIN_INTERVALS):
+        self.categories = categories
+        self.reserved = reserved
+        self.shared = shared
+        self.priorities = priorities
+        self.min_intervals = min_intervals
+        self.category_channels = {}
+        self.shared_channels = []
+        self.voices = {}
+        self.last_played = {}
+        self.buffer_latency = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.triggers = 0
+        self.dropped = 0
+        self.stolen = 0
+
+    def prepare(self, frequency, buffer_size):
+        reserved_count = sum(self.reserved.values())
+        pygame.mixer.set_num_channels(reserved_count + self.shared)
+        pygame.mixer.set_reserved(reserved_count)
+        index = 0
+        for category, count in sorted(self.reserved.items()):
+            channels = []
+            for _ in range(count):
+                channels.append(pygame.mixer.Channel(index))
+                index += 1
+            self.category_channels[category] = channels
+        for _ in range(self.shared):
+            self.shared_channels.append(pygame.mixer.Channel(index))
+            index += 1
+        self.buffer_latency = buffer_size / float(frequency)
+
+    def play(self, key, sound, request_time):
+        min_interval = self.min_intervals.get(key, 0)
+        last_time = self.last_played.get(key)
+        if last_time is not None and request_time - last_time < min_interval:
+            self.dropped += 1
+            return
+        channel = self.find_channel(key)
+        if channel is None:
+            self.dropped += 1
+            return
+        channel.play(sound)
+        self.voices[channel] = (self.priorities.get(key, 0), request_time)
+        self.last_played[key] = request_time
+        self.measure_latency(request_time)
+
+    def find_channel(self, key):
+        own = self.category_channels.get(self.categories.get(key), [])
+        candidates = own + self.shared_channels
+        for channel in candidates:
+            if not channel.get_busy():
+                return channel
+        return self.steal_channel(key, candidates)
+
+    def steal_channel(self, key, candidates):
+        priority = self.priorities.get(key, 0)
+        victim = None
+        victim_voice = None
+        for channel in candidates:
+            voice = self.voices.get(channel, (0, 0.0))
+            if voice[0] > priority:
+                continue
+            if victim is None or voice < victim_voice:
+                victim = channel
+                victim_voice = voice
+        if victim is not None:
+            victim.stop()
+            self.stolen += 1
+        return victim
+
+    def measure_latency(self, request_time):
+        latency = time.perf_counter() - request_time + self.buffer_latency
+        self.triggers += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def report(self):
+        if not self.triggers:
+            return 'DŹWIĘK: BRAK ODTWORZEŃ'
+        return ('DŹWIĘK: OPÓŹNIENIE ŚR. {:.1f} MS, MAKS. {:.1f} MS, '
+                'ODRZUCONE {}, PRZEJĘTE {}').format(
+                    self.latency_total / self.triggers * 1000,
+                    self.latency_max * 1000, self.dropped, self.stolen)
+
 
 class SoundManager:
 
-    def __init__(self, path):
+    def __init__(self, path, cache_bytes=SOUND_CACHE_BYTES,
+                 hot_sounds=HOT_SOUNDS):
         self.path = path
         self.mute = False
-        self.sounds = {}
+        self.paths = {}
+        self.sounds = SoundCache(cache_bytes)
+        self.hot_sounds = hot_sounds
+        self.channels = ChannelManager()
+        self.lock = threading.Lock()
+        self.ready = False
+        self.has_music = False
+        self.frequency = 44100
+        self.buffer_size = 512
+
+    def configure(self, frequency, buffer_size):
+        self.frequency = frequency
+        self.buffer_size = buffer_size
 
     def set_mute(self, value):
         self.mute = value
+        if self.ready:
+            self.apply_mute()
+
+    def apply_mute(self):
+        if not self.has_music:
+            return
         if self.mute:
             pygame.mixer.music.stop()
         else:
             pygame.mixer.music.play(-1)
 
-    def prepare(self):
-        pygame.mixer.init()
-        self.load_sounds()
+    def prepare(self, bg_music_file=None):
+        pygame.mixer.init(frequency=self.frequency, buffer=self.buffer_size)
+        self.channels.prepare(self.frequency, self.buffer_size)
+        self.index_sounds()
+        self.prefetch(self.hot_sounds)
+        if bg_music_file is not None:
+            self.load_bg_music(bg_music_file)
+        # Dopiero teraz, żeby pierwsze play() nie czekało na blokadzie
+        # trzymanej przez wątek wczytujący.
+        self.ready = True
+        self.apply_mute()
+
+    def prepare_in_background(self, bg_music_file=None, on_ready=None):
+        def prepare():
+            try:
+                self.prepare(bg_music_file)
+            except pygame.error as error:
+                print('BŁĄD DŹWIĘKU: {}'.format(error))
+            else:
+                if on_ready is not None:
+                    on_ready()
+
+        thread = threading.Thread(target=prepare, daemon=True)
+        thread.start()
+        return thread
 
     def load_bg_music(self, file_name):
-        pygame.mixer.music.load(file_name)
+        try:
+            pygame.mixer.music.load(file_name)
+        except pygame.error:
+            print('BRAK MUZYKI: {}'.format(file_name))
+        else:
+            self.has_music = True
 
-    def load_sounds(self):
+    def index_sounds(self):
         for filename in os.listdir(self.path):
             if filename.endswith(".wav"):
-                sound = pygame.mixer.Sound(os.path.join(self.path, filename))
-                self.sounds[self.make_key(filename)] = sound
+                self.paths[self.make_key(filename)] = os.path.join(
+                    self.path, filename)
+
+    def prefetch(self, keys):
+        for key in keys:
+            self.get_sound(key)
 
     def make_key(self, filename):
         return os.path.splitext(filename)[0]
 
+    def get_sound(self, key):
+        with self.lock:
+            sound = self.sounds.get(key)
+            if sound is None and key in self.paths:
+                sound = self.decode(key)
+            return sound
+
+    def decode(self, key):
+        try:
+            sound = pygame.mixer.Sound(self.paths[key])
+        except pygame.error as error:
+            print('BŁĄD DŹWIĘKU {}: {}'.format(key, error))
+            del self.paths[key]
+            return None
+        self.sounds.put(key, sound, self.measure(sound))
+        return sound
+
+    def measure(self, sound):
+        frequency, size, channels = pygame.mixer.get_init()
+        return int(sound.get_length() * frequency * channels * abs(size) // 8)
+
     def play(self, key):
-        if not self.mute:
-            sound = self.sounds[key]
-            sound.play()
+        if self.ready and not self.mute:
+            request_time = time.perf_counter()
+            sound = self.get_sound(key)
+            if sound is not None:
+                self.channels.play(key, sound, request_time)
+
+
+class StartupTimer:
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.last_time = self.start_time
+        self.steps = []
+
+    def mark(self, name):
+        current_time = time.perf_counter()
+        self.steps.append((name, current_time - self.last_time))
+        self.last_time = current_time
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def report(self):
+        steps = ', '.join(
+            '{} {:.1f} MS'.format(name, duration * 1000)
+            for name, duration in self.steps)
+        return 'START: {} (RAZEM {:.1f} MS)'.format(
+            steps, self.elapsed() * 1000)
+
+
+class FrameClock:
+
+    def __init__(self, target_fps, vsync=False, spin_time=FRAME_SPIN_TIME):
+        self.target_fps = target_fps
+        self.vsync = vsync
+        self.spin_time = spin_time
+        self.frame_time = 1.0 / target_fps if target_fps else 0.0
+        self.last_time = None
+        self.frame_start = None
+        self.frames = 0
+        self.window_start = None
+        self.window_frames = 0
+        self.achieved_fps = 0.0
+        self.work_time = 0.0
+
+    def tick(self):
+        current_time = time.perf_counter()
+        if self.last_time is None:
+            self.last_time = current_time
+            self.window_start = current_time
+        delta_time = current_time - self.last_time
+        self.last_time = current_time
+        self.frame_start = current_time
+        self.frames += 1
+        self.window_frames += 1
+        window = current_time - self.window_start
+        if window >= 1.0:
+            self.achieved_fps = self.window_frames / window
+            self.window_start = current_time
+            self.window_frames = 0
+        return delta_time
+
+    def wait(self):
+        now = time.perf_counter()
+        self.work_time = now - self.frame_start
+        if self.vsync or not self.frame_time:
+            return
+        deadline = self.frame_start + self.frame_time
+        remaining = deadline - now
+        # Sen bywa niedokładny, więc aktywnie czekamy tylko ostatnią
+        # milisekundę.
+        if remaining > self.spin_time:
+            time.sleep(remaining - self.spin_time)
+        while time.perf_counter() < deadline:
+            time.sleep(0)
+
+    async def wait_async(self):
+        now = time.perf_counter()
+        self.work_time = now - self.frame_start
+        remaining = 0.0
+        if not self.vsync and self.frame_time:
+            remaining = self.frame_start + self.frame_time - now
+        await asyncio.sleep(max(remaining, 0.0))
+
+    def get_fps(self):
+        return self.achieved_fps
+
+    def report(self):
+        return 'FPS: {:.1f} / {} (PRACA: {:.1f} MS)'.format(
+            self.achieved_fps, self.target_fps or '-', self.work_time * 1000)
+
+
+BoardSnapshot = collections.namedtuple(
+    'BoardSnapshot',
+    ['static_cells', 'curr_cells', 'ghost_distance', 'game_over',
+     'next_cells', 'origin', 'counters', 'animations'])
+
+
+class SnapshotBuffer:
+
+    def __init__(self):
+        self.slots = [None, None]
+        self.front = 0
+
+    def publish(self, snapshot):
+        back = 1 - self.front
+        self.slots[back] = snapshot
+        self.front = back
+
+    def read(self):
+        return self.slots[self.front]
+
+
+class SimulationThread(threading.Thread):
+
+    def __init__(self, activity, tick_rate):
+        super().__init__(daemon=True)
+        self.activity = activity
+        self.tick_time = 1.0 / tick_rate
+        self.inputs = collections.deque()
+        self.running = False
+
+    def post(self, handler, *args):
+        self.inputs.append((handler, args))
+
+    def run(self):
+        self.running = True
+        next_tick = time.perf_counter()
+        while self.running:
+            while self.inputs:
+                handler, args = self.inputs.popleft()
+                handler(*args)
+            self.activity.update(self.tick_time)
+
+            next_tick += self.tick_time
+            remaining = next_tick - time.perf_counter()
+            if remaining > 0:
+                time.sleep(remaining)
+            elif remaining < -self.tick_time * 10:
+                next_tick = time.perf_counter()
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def write_json_atomic(path, data):
+    write_atomic(path, 'w', lambda document: json.dump(data, document))
+
+
+def write_bytes_atomic(path, data):
+    write_atomic(path, 'wb', lambda document: document.write(data))
+
+
+def write_atomic(path, mode, write):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, mode) as document:
+            write(document)
+            document.flush()
+            os.fsync(document.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class IOWorker(threading.Thread):
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.pending = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.running = False
+        self.busy = False
+
+    def submit(self, func, *args):
+        with self.condition:
+            self.pending.pop(func, None)
+            self.pending[func] = args
+            self.condition.notify()
+
+    def run(self):
+        self.running = True
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                func, args = self.pending.popitem(last=False)
+                self.busy = True
+            try:
+                func(*args)
+            except Exception as error:
+                print('BŁĄD ZAPISU: {}'.format(error))
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+    def flush(self):
+        with self.condition:
+            while self.pending or self.busy:
+                self.condition.wait()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.join()
 
 
 class SettingsManager:
 
-    def __init__(self, settings_file):
+    def __init__(self, settings_file, defaults=None,
+                 debounce=SETTINGS_DEBOUNCE):
         self.settings_file = settings_file
+        self.defaults = SETTINGS_DEFAULTS if defaults is None else defaults
+        self.debounce = debounce
         self.settings = {}
+        self.dirty = False
+        self.change_time = None
+        self.lock = threading.Lock()
 
-    def get(self, key, default_value):
+    def get(self, key, default_value=None):
+        if default_value is None:
+            default_value = self.defaults.get(key)
         return self.settings.get(key, default_value)
 
     def set(self, key, value):
-        self.settings[key] = value
-        self.save()
+        with self.lock:
+            self.settings[key] = value
+            self.dirty = True
+            self.change_time = time.perf_counter()
 
     def prepare(self):
         self.load()
 
     def load(self):
+        self.settings = {}
         try:
             with open(self.settings_file) as document:
-                self.settings = json.load(document)
+                settings = json.load(document)
         except IOError as error:
             if os.path.exists(self.settings_file):
                 raise error
             else:
                 print('NIE WCZYTANO PLIKU USTAWIEŃ (POWÓD: BRAK PLIKU)')
         else:
+            self.settings = self.validate(settings)
             print('WCZYTANO PLIK USTAWIEŃ')
 
-    def save(self):
-        with open(self.settings_file, 'w') as document:
-            json.dump(self.settings, document)
+    def validate(self, settings):
+        valid = {}
+        for key, value in settings.items():
+            if key in self.defaults and not (
+                    self.has_valid_type(key, value) and
+                    self.has_valid_value(key, value)):
+                # Zostaje wartość domyślna.
+                print('NIEPOPRAWNE USTAWIENIE: {}'.format(key))
+                continue
+            valid[key] = value
+        return valid
+
+    def has_valid_type(self, key, value):
+        default = self.defaults[key]
+        if isinstance(default, bool) or isinstance(value, bool):
+            return isinstance(default, bool) and isinstance(value, bool)
+        if isinstance(default, (int, float)):
+            return isinstance(value, (int, float))
+        return isinstance(value, type(default))
+
+    def has_valid_value(self, key, value):
+        if key in SETTINGS_RANGES:
+            low, high = SETTINGS_RANGES[key]
+            return low <= value <= high
+        if key in SETTINGS_CHOICES:
+            return value in SETTINGS_CHOICES[key]
+        return True
+
+    def take_changes(self, current_time):
+        # Zmiany zebrane w czasie debounce zapisujemy jednym plikiem.
+        with self.lock:
+            if (not self.dirty or
+                    current_time - self.change_time < self.debounce):
+                return None
+            self.dirty = False
+            return dict(self.settings)
+
+    def close(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            settings = dict(self.settings)
+        self.write(settings)
+
+    def write(self, settings):
+        write_json_atomic(self.settings_file, settings)
 
 
 class ActivityContainer:
@@ -624,25 +1646,86 @@ class ActivityContainer:
         self.painter = Painter(width, height)
         self.sound_manager = SoundManager(SOUNDS_DIR)
         self.settings_manager = SettingsManager(SETTING_FILE)
-        self.last_time = None
+        self.frame_clock = None
+        self.last_report_time = None
+        self.simulation = None
+        self.main_calls = collections.deque()
+        self.loop = None
+        self.io_tasks = set()
+        self.io_worker = IOWorker()
+        self.piece_store = PieceStore(PIECE_STORE_FILE)
+        self.piece_records = bytearray()
+        self.piece_records_lock = threading.Lock()
+        self.feed = None
+        self.autosave_interval = AUTOSAVE_INTERVAL
+        self.fps_report = False
+        self.last_autosave_time = None
+        self.startup_timer = None
         self.title = title
 
     def run_activity(self, activity):
-        pygame.init()
-        self.painter.run()
+        self.prepare_activity(activity)
 
-        self.settings_manager.prepare()
+        self.running = True
+        while self.running:
+            delta_time = self.frame_clock.tick()
+            self.run_frame(activity, delta_time)
+            self.frame_clock.wait()
+
+        self.finish(activity)
 
-        self.sound_manager.prepare()
-        self.sound_manager.load_bg_music('bg.wav')
-        self.sound_manager.set_mute(self.settings_manager.get('mute', False))
+    async def run_activity_async(self, activity):
+        self.loop = asyncio.get_running_loop()
+        self.prepare_activity(activity)
+
+        self.running = True
+        while self.running:
+            delta_time = self.frame_clock.tick()
+            self.run_frame(activity, delta_time)
+            await self.frame_clock.wait_async()
+
+        if self.io_tasks:
+            await asyncio.gather(*self.io_tasks)
+        self.finish(activity)
+
+    def prepare_activity(self, activity):
+        self.startup_timer = StartupTimer()
+        pygame.display.init()
+        self.io_worker.start()
+        self.startup_timer.mark('DISPLAY')
+
+        self.settings_manager.prepare()
+        self.autosave_interval = self.settings_manager.get('autosave_interval')
+        self.fps_report = self.settings_manager.get('fps_report')
+        self.startup_timer.mark('USTAWIENIA')
+
+        vsync = self.settings_manager.get('vsync')
+        self.painter.run(
+            vsync, self.settings_manager.get('font_path'),
+            self.settings_manager.get('display_mode'),
+            self.settings_manager.get('smooth_scale'))
+        if self.painter.font_path != self.settings_manager.get('font_path'):
+            self.settings_manager.set('font_path', self.painter.font_path)
+        self.frame_clock = FrameClock(
+            self.settings_manager.get('target_fps'), vsync)
+        self.startup_timer.mark('OKNO I CZCIONKA')
+
+        self.sound_manager.set_mute(self.settings_manager.get('mute'))
+        self.sound_manager.configure(
+            self.settings_manager.get('audio_frequency'),
+            self.settings_manager.get('audio_buffer'))
+        self.sound_manager.prepare_in_background(
+            BG_MUSIC_FILE, self.on_sound_ready)
 
         self.set_window_title(self.title)
 
         activity.prepare()
+        self.startup_timer.mark('AKTYWNOŚCI')
 
         activity.add_listener('PAUSE', self.on_paused)
         activity.add_listener('UNPAUSE', self.on_unpaused)
+        activity.add_listener('REPLAY', self.on_replay)
+        activity.add_listener('PIECES', self.on_pieces)
 
         activity.add_exit_listener(self.on_exit)
         activity.add_load_listener(lambda: self.on_load(activity))
@@ -650,47 +1733,102 @@ class ActivityContainer:
         activity.add_sound_listener(self.on_sound)
         activity.add_toggle_mute_listener(self.on_toggle_mute)
 
-        self.running = True
-        while self.running:
-            delta_time = self.calculate_delta_time()
-            self.process_activity_events(activity)
-            activity.update(delta_time)
-            self.painter.render_background()
-            activity.render(self.painter)
-            pygame.display.update()
-            time.sleep(0.05)
+        if self.settings_manager.get('animations'):
+            activity.enable_animations()
+
+        if self.settings_manager.get('live_feed'):
+            self.feed = BoardFeed(FEED_NAME, *activity.get_board_shape())
+            activity.enable_feed(self.feed)
+
+        if self.settings_manager.get('simulation_thread'):
+            activity.enable_snapshots()
+            self.simulation = SimulationThread(
+                activity,
+                self.settings_manager.get('simulation_tick_rate'))
+            self.simulation.start()
 
+    def run_frame(self, activity, delta_time):
+        self.process_activity_events(activity)
+        self.process_main_calls()
+        if self.simulation is None:
+            activity.update(delta_time)
+        self.painter.render_background()
+        activity.render(self.painter)
+        self.painter.present()
+        self.report_fps()
+        self.check_autosave(activity)
+        self.check_settings()
+        if self.frame_clock.frames == 1:
+            self.startup_timer.mark('PIERWSZA KLATKA')
+            print(self.startup_timer.report())
+
+    def finish(self, activity):
+        if self.simulation is not None:
+            self.simulation.stop()
+        with self.piece_records_lock:
+            self.piece_records += activity.take_piece_records()
+        self.io_worker.stop()
+        self.write_pieces()
+        self.settings_manager.close()
+        if self.feed is not None:
+            self.feed.close()
+        print(self.sound_manager.channels.report())
+        print(self.frame_clock.report())
         pygame.quit()
         sys.exit(0)
 
-    def calculate_delta_time(self):
-        if self.last_time is None:
-            self.last_time = time.time()
-        current_time = time.time()
-        delta_time = current_time - self.last_time
-        self.last_time = current_time
-        return delta_time
+    def report_fps(self):
+        if not self.fps_report:
+            return
+        current_time = self.frame_clock.frame_start
+        if self.last_report_time is None:
+            self.last_report_time = current_time
+        elif current_time - self.last_report_time >= FPS_REPORT_INTERVAL:
+            self.last_report_time = current_time
+            print(self.frame_clock.report())
 
     def process_activity_events(self, activity):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.running = False
+            elif event.type == pygame.VIDEORESIZE:
+                self.painter.resize(event.w, event.h)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F11:
+                self.painter.toggle_fullscreen()
             elif event.type == pygame.KEYDOWN:
-                activity.on_keydown(event.key)
+                self.dispatch(activity.on_keydown, event.key)
             elif event.type == pygame.KEYUP:
-                activity.on_keyup(event.key)
+                self.dispatch(activity.on_keyup, event.key)
             elif event.type == pygame.MOUSEMOTION:
-                x, y = pygame.mouse.get_pos()
-                activity.on_mouse(x, y)
+                x, y = self.painter.to_logical(*pygame.mouse.get_pos())
+                self.dispatch(activity.on_mouse, x, y)
             elif event.type == pygame.MOUSEBUTTONUP:
-                x, y = pygame.mouse.get_pos()
-                activity.on_click(x, y)
+                x, y = self.painter.to_logical(*pygame.mouse.get_pos())
+                self.dispatch(activity.on_click, x, y)
+
+    def dispatch(self, handler, *args):
+        if self.simulation is None:
+            handler(*args)
+        else:
+            self.simulation.post(handler, *args)
+
+    def call_on_main(self, handler, *args):
+        if self.simulation is None:
+            handler(*args)
+        else:
+            self.main_calls.append((handler, args))
+
+    def process_main_calls(self):
+        while self.main_calls:
+            handler, args = self.main_calls.popleft()
+            handler(*args)
 
     def on_paused(self):
-        self.set_window_title('{}:PAUSED!'.format(self.title))
+        self.call_on_main(
+            self.set_window_title, '{}:PAUSED!'.format(self.title))
 
     def on_unpaused(self):
-        self.set_window_title('{}'.format(self.title))
+        self.call_on_main(self.set_window_title, '{}'.format(self.title))
 
     def set_window_title(self, title):
         pygame.display.set_caption(title)
@@ -698,20 +1836,104 @@ class ActivityContainer:
     def on_exit(self):
         self.running = False
 
+    def run_io(self, func, *args, callback=None):
+        if self.loop is None and callback is None:
+            self.io_worker.submit(func, *args)
+        elif self.loop is None:
+            result = func(*args)
+            if result is not None:
+                callback(result)
+        else:
+            self.call_on_main(self.start_io_task, func, args, callback)
+
+    def start_io_task(self, func, args, callback):
+        task = self.loop.create_task(self.run_io_async(func, args, callback))
+        self.io_tasks.add(task)
+        task.add_done_callback(self.io_tasks.discard)
+
+    async def run_io_async(self, func, args, callback):
+        result = await self.loop.run_in_executor(None, func, *args)
+        if callback is not None and result is not None:
+            self.dispatch(callback, result)
+
     def on_load(self, activity):
+        self.run_io(self.read_game_state, callback=activity.set_state)
+
+    def on_save(self, activity):
+        self.run_io(self.write_game_state, activity.get_state())
+
+    def check_autosave(self, activity):
+        if not self.autosave_interval:
+            return
+        current_time = self.frame_clock.frame_start
+        if self.last_autosave_time is None:
+            self.last_autosave_time = current_time
+        elif current_time - self.last_autosave_time >= self.autosave_interval:
+            self.last_autosave_time = current_time
+            self.dispatch(self.autosave, activity)
+
+    def check_settings(self):
+        settings = self.settings_manager.take_changes(
+            self.frame_clock.frame_start)
+        if settings is not None:
+            self.run_io(self.settings_manager.write, settings)
+
+    def autosave(self, activity):
+        if activity.has_state():
+            self.run_io(self.write_autosave, activity.get_state())
+
+    def read_game_state(self):
+        # Autozapis jest nowszy od zapisu gracza, gdy gra się przerwała
+        # albo gracz nigdy nie zapisał gry, i wtedy wczytujemy autozapis.
+        path = GAME_STATE_FILE
+        if (os.path.exists(AUTOSAVE_FILE) and (
+                not os.path.exists(GAME_STATE_FILE) or
+                os.path.getmtime(AUTOSAVE_FILE) >
+                os.path.getmtime(GAME_STATE_FILE))):
+            path = AUTOSAVE_FILE
         try:
-            with open(GAME_STATE_FILE, 'r') as doc:
-                activity.set_state(json.load(doc))
+            with open(path, 'r') as doc:
+                state = json.load(doc)
         except IOError:
             print('BŁĄD WCZYTYWANIA')
+            return None
         else:
-            print('GRA WCZYTANA')
+            if path == AUTOSAVE_FILE:
+                print('WCZYTANO AUTOZAPIS')
+            else:
+                print('GRA WCZYTANA')
+            return state
 
-    def on_save(self, activity):
-        with open(GAME_STATE_FILE, 'w') as doc:
-            json.dump(activity.get_state(), doc)
+    def write_game_state(self, state):
+        write_json_atomic(GAME_STATE_FILE, state)
         print('GRA ZAPISANA')
 
+    def write_autosave(self, state):
+        write_json_atomic(AUTOSAVE_FILE, state)
+
+    def on_replay(self, data):
+        self.run_io(self.write_replay, data)
+
+    def on_pieces(self, records):
+        with self.piece_records_lock:
+            self.piece_records += records
+        self.run_io(self.write_pieces)
+
+    def write_pieces(self):
+        with self.piece_records_lock:
+            records = bytes(self.piece_records)
+            self.piece_records.clear()
+        if records:
+            self.piece_store.append(records)
+
+    def write_replay(self, data):
+        write_bytes_atomic(REPLAY_FILE, data)
+        print('ZAPISANO POWTÓRKĘ')
+
+    def on_sound_ready(self):
+        print('DŹWIĘK GOTOWY PO {:.1f} MS'.format(
+            self.startup_timer.elapsed() * 1000))
+
     def on_sound(self, sound_name):
         self.sound_manager.play(sound_name)
 
@@ -762,15 +1984,17 @@ class NextBlockView:
         self.box_size = 15
 
     def render(self, painter):
-        block = self.value_provider()
+        cells = self.value_provider()
+        if not cells:
+            return
+        bottom_row = max(row for row, _, _ in cells)
+        right_col = max(col for _, col, _ in cells)
 
-        for box in block.boxes:
-            rows = block.get_bottom_box().row - box.row
-            cols = block.get_right_box().col - box.col
-            x = self.box_size * cols
-            y = self.box_size * rows
+        for row, col, color in cells:
+            x = self.box_size * (right_col - col)
+            y = self.box_size * (bottom_row - row)
             painter.fill_rect(
-                self.x + x, self.y + y, self.box_size, self.box_size, box.color)
+                self.x + x, self.y + y, self.box_size, self.box_size, color)
             painter.draw_rect(
                 self.x + x, self.y + y, self.box_size, self.box_size, COLOR_WHITE)
 
@@ -813,56 +2037,240 @@ class Box:
         painter.fill_rect(x, y, w, h, self.color)
 
 
+ZOBRIST_MASK = (1 << 64) - 1
+ZOBRIST_CELL = 1
+ZOBRIST_PIECE = 2
+ZOBRIST_POSITION = 3
+
+
+def splitmix64(value):
+    value = (value + 0x9E3779B97F4A7C15) & ZOBRIST_MASK
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & ZOBRIST_MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & ZOBRIST_MASK
+    return value ^ (value >> 31)
+
+
+@functools.lru_cache(maxsize=65536)
+def zobrist_key(domain, first, second):
+    return splitmix64(
+        (domain << 56) ^ ((first & 0xFFFFFFF) << 28) ^ (second & 0xFFFFFFF))
+
+
+def zobrist_grid(masks):
+    value = 0
+    for row, mask in enumerate(masks):
+        col = 0
+        while mask:
+            if mask & 1:
+                value ^= zobrist_key(ZOBRIST_CELL, row, col)
+            mask >>= 1
+            col += 1
+    return value
+
+
+class BoardFeatures:
+
+    def __init__(self, row_count, col_count):
+        self.row_count = row_count
+        self.col_count = col_count
+        self.tops = [row_count] * col_count
+        self.holes = [0] * col_count
+        self.aggregate_height = 0
+        self.total_holes = 0
+        self.bumpiness = 0
+        self.wells = 0
+        self.row_transitions = 2 * row_count
+
+    def copy(self):
+        features = BoardFeatures.__new__(BoardFeatures)
+        features.__dict__.update(self.__dict__)
+        features.tops = self.tops[:]
+        features.holes = self.holes[:]
+        return features
+
+    def get_height(self, col):
+        return self.row_count - self.tops[col]
+
+    def get_well(self, col):
+        tops = self.tops
+        left = tops[col - 1] if col > 0 else 0
+        right = tops[col + 1] if col < self.col_count - 1 else 0
+        depth = tops[col] - max(left, right)
+        return depth if depth > 0 else 0
+
+    def get_bump(self, col):
+        return abs(self.tops[col] - self.tops[col + 1])
+
+    def add_cells(self, cells, is_filled):
+        column_cells = {}
+        pending = set(cells)
+        for row, col in cells:
+            pending.discard((row, col))
+            if row < 0:
+                continue
+            for neighbour in (col - 1, col + 1):
+                if (neighbour < 0 or neighbour >= self.col_count or
+                        (is_filled(row, neighbour) and
+                         (row, neighbour) not in pending)):
+                    self.row_transitions -= 1
+                else:
+                    self.row_transitions += 1
+            if col in column_cells:
+                top, count = column_cells[col]
+                column_cells[col] = (min(top, row), count + 1)
+            else:
+                column_cells[col] = (row, 1)
+
+        for col, (top, count) in column_cells.items():
+            old_top = self.tops[col]
+            delta = max(old_top - top, 0) - count
+            self.holes[col] += delta
+            self.total_holes += delta
+            if top < old_top:
+                self.set_top(col, top)
+
+    def set_top(self, col, top):
+        first = col - 1 if col > 0 else col
+        last = col + 1 if col < self.col_count - 1 else col
+        wells = 0
+        bumpiness = 0
+        for other in range(first, last + 1):
+            wells -= self.get_well(other)
+        for other in range(first, last):
+            bumpiness -= self.get_bump(other)
+        self.aggregate_height += self.tops[col] - top
+        self.tops[col] = top
+        for other in range(first, last + 1):
+            wells += self.get_well(other)
+        for other in range(first, last):
+            bumpiness += self.get_bump(other)
+        self.wells += wells
+        self.bumpiness += bumpiness
+
+    def remove_full_row(self, row, is_filled):
+        for col in range(self.col_count):
+            top = self.tops[col]
+            if top < row:
+                self.tops[col] = top + 1
+                continue
+            below = row + 1
+            while below < self.row_count and not is_filled(below, col):
+                below += 1
+            gap = below - row - 1
+            self.holes[col] -= gap
+            self.total_holes -= gap
+            self.tops[col] = below
+        self.row_transitions += 2
+        self.aggregate_height = sum(
+            self.row_count - top for top in self.tops)
+        self.bumpiness = sum(
+            self.get_bump(col) for col in range(self.col_count - 1))
+        self.wells = sum(self.get_well(col) for col in range(self.col_count))
+
+
 class StaticBoxGroup:
 
     def __init__(self, row_count, col_count):
-        self.rows = self.make_rows(row_count, col_count)
+        # Tylko zajęte wiersze są przechowywane, więc koszt operacji zależy
+        # od liczby leżących klocków, a nie od rozmiaru planszy.
+        self.rows = {}
+        self.full_rows = set()
         self.boxes = []
         self.row_count = row_count
         self.col_count = col_count
-
-    def make_rows(self, rows_count, col_count):
-        rows = []
-        for _ in range(rows_count):
-            rows.append(self.make_row(col_count))
-        return rows
+        self.version = 0
+        self.features = BoardFeatures(row_count, col_count)
+        self.zobrist = 0
 
     def make_row(self, row_size):
         return [None] * row_size
 
+    def iter_rows(self, first, last):
+        rows = self.rows
+        if len(rows) < last - first:
+            for row_index in sorted(rows):
+                if first <= row_index < last:
+                    yield row_index, rows[row_index]
+        else:
+            for row_index in range(first, last):
+                row = rows.get(row_index)
+                if row is not None:
+                    yield row_index, row
+
     def has_collision(self, block):
-        for box in self.boxes:
-            if box in block.boxes:
+        for box in block.boxes:
+            if (0 <= box.col < self.col_count and
+                    self.is_filled(box.row, box.col)):
                 return True
         return False
 
     def add_boxes(self, boxes):
         for box in boxes:
-            self.rows[box.row][box.col] = box
+            row = self.rows.get(box.row)
+            if row is None:
+                row = self.rows[box.row] = self.make_row(self.col_count)
+            row[box.col] = box
             self.boxes.append(box)
+            self.zobrist ^= zobrist_key(ZOBRIST_CELL, box.row, box.col)
+        for row_index in set(box.row for box in boxes):
+            if (0 <= row_index < self.row_count and
+                    self.is_full_row(self.rows[row_index])):
+                self.full_rows.add(row_index)
+        self.features.add_cells(
+            [(box.row, box.col) for box in boxes], self.is_filled)
+        self.version += 1
+
+    def is_filled(self, row, col):
+        row = self.rows.get(row)
+        return row is not None and row[col] is not None
 
     def clear_full_rows(self):
         lines = 0
-        row_index = self.row_count - 1
-        while row_index > -1 and not self.is_empty_row(self.rows[row_index]):
-            if self.is_full_row(self.rows[row_index]):
-                self.remove_row(row_index)
-                lines += 1
-                continue
-            row_index -= 1
+        while self.full_rows:
+            self.remove_row(max(self.full_rows))
+            lines += 1
         return lines
 
     def remove_row(self, row_index):
-        for box in self.rows[row_index]:
-            self.boxes.remove(box)
-        self.rows.pop(row_index)
+        self.features.remove_full_row(row_index, self.is_filled)
+        removed = self.rows.pop(row_index)
+        for box in removed:
+            self.zobrist ^= zobrist_key(ZOBRIST_CELL, row_index, box.col)
+        self.boxes[:] = [box for box in self.boxes if box.row != row_index]
         for box in self.boxes:
             if row_index > box.row:
+                self.zobrist ^= (
+                    zobrist_key(ZOBRIST_CELL, box.row, box.col) ^
+                    zobrist_key(ZOBRIST_CELL, box.row + 1, box.col))
                 box.row += 1
-        self.rows.insert(0, self.make_row(self.col_count))
-
-    def is_empty_row(self, row):
-        return row.count(None) == self.col_count
+        self.rows = {
+            index + 1 if index < row_index else index: row
+            for index, row in self.rows.items()}
+        self.full_rows = set(
+            index + 1 if index < row_index else index
+            for index in self.full_rows if index != row_index)
+        self.version += 1
+
+    def get_landing_row(self, row, col):
+        landing_row = max(row + 1, 0)
+        top = self.features.tops[col]
+        if landing_row <= top:
+            return top - 1
+        while (landing_row < self.row_count and
+               not self.is_filled(landing_row, col)):
+            landing_row += 1
+        return landing_row - 1
+
+    def get_row_masks(self):
+        masks = [0] * self.row_count
+        for row_index, row in self.rows.items():
+            if 0 <= row_index < self.row_count:
+                mask = 0
+                for col, box in enumerate(row):
+                    if box is not None:
+                        mask |= 1 << col
+                masks[row_index] = mask
+        return tuple(masks)
 
     def is_full_row(self, row):
         return row.count(None) == 0
@@ -877,33 +2285,379 @@ class StaticBoxGroup:
         for box_state in state['boxes']:
             box = Box.from_state(self, box_state)
             boxes.append(box)
+        self.set_boxes(boxes)
+
+    def set_boxes(self, boxes):
         self.boxes.clear()
+        self.rows = {}
+        self.full_rows = set()
+        self.features = BoardFeatures(self.row_count, self.col_count)
+        self.zobrist = 0
         self.add_boxes(boxes)
 
+    def pack_cells(self, get_color_index):
+        # Zapisujemy tylko zajęte wiersze: numer wiersza i kolory komórek.
+        chunks = []
+        for row_index in sorted(self.rows):
+            if not 0 <= row_index < self.row_count:
+                continue
+            colors = bytearray(self.col_count)
+            for col, box in enumerate(self.rows[row_index]):
+                if box is not None:
+                    colors[col] = get_color_index(box.color)
+            chunks.append(PACKED_ROW.pack(row_index))
+            chunks.append(colors)
+        return b''.join(chunks)
+
+    def unpack_cells(self, cells, palette, board):
+        boxes = []
+        for row, colors in iter_packed_rows(cells, self.col_count):
+            for col, color_index in enumerate(colors):
+                if color_index:
+                    boxes.append(Box(row, col, palette[color_index], board))
+        self.set_boxes(boxes)
 
-class Board:
 
-    def __init__(self, block_factories, get_level):
-        self.x, self.y, self.w, self.h = BOARD_GEOMETRY
-        self.box_size = BOX_SIZE
-        self.block_factories = block_factories
-        self.grid_color = GRID_COLOR
-        self.background_color = COLOR_WHITE
-        self.curr_block = None
-        self.next_block = None
-        self.block_start_row = 0
-        self.block_end_row = self.h // self.box_size
-        self.block_start_col = 0
-        self.block_end_col = self.w // self.box_size
-        self.block_mid_col = (self.w // self.box_size) // 2 - 1
-        self.static_boxes = StaticBoxGroup(
-            self.block_end_row, self.block_end_col)
-        self.game_over = False
+PACKED_ROW = struct.Struct('<H')
+
+
+def iter_packed_rows(cells, cols):
+    step = PACKED_ROW.size + cols
+    for offset in range(0, len(cells), step):
+        row, = PACKED_ROW.unpack_from(cells, offset)
+        yield row, cells[offset + PACKED_ROW.size:offset + step]
+
+
+CompactSnapshot = collections.namedtuple(
+    'CompactSnapshot', ['cells', 'next_kind', 'rng_state', 'scores', 'lines'])
+
+
+def pack_rng_state(rng):
+    _, internal_state, _ = rng.getstate()
+    return array.array('I', internal_state).tobytes()
+
+
+def unpack_rng_state(rng, data):
+    internal_state = array.array('I')
+    internal_state.frombytes(data)
+    rng.setstate((3, tuple(internal_state), None))
+
+
+class RewindBuffer:
+
+    def __init__(self, capacity=REWIND_CAPACITY):
+        self.slots = [None] * capacity
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+
+    def push(self, snapshot):
+        self.slots[self.head] = snapshot
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def peek(self):
+        if not self.count:
+            return None
+        return self.slots[(self.head - 1) % self.capacity]
+
+    def step_back(self):
+        if self.count < 2:
+            return self.peek()
+        self.head = (self.head - 1) % self.capacity
+        self.slots[self.head] = None
+        self.count -= 1
+        return self.peek()
+
+    def clear(self):
+        self.slots = [None] * self.capacity
+        self.head = 0
+        self.count = 0
+
+
+class Camera:
+
+    def __init__(self, row_count, col_count, view_rows, view_cols, box_size,
+                 speed=CAMERA_SPEED):
+        self.max_top = row_count - view_rows
+        self.max_left = col_count - view_cols
+        self.view_rows = view_rows
+        self.view_cols = view_cols
+        self.box_size = box_size
+        self.speed = speed
+        self.top = 0.0
+        self.left = 0.0
+        self.target_top = 0
+        self.target_left = 0
+
+    def follow(self, row, col):
+        self.target_top = min(max(row - self.view_rows // 2, 0), self.max_top)
+        self.target_left = min(
+            max(col - self.view_cols // 2, 0), self.max_left)
+
+    def update(self, delta_time):
+        # Wykładnicze dochodzenie do celu nie zależy od liczby klatek,
+        # a przy odległości poniżej piksela widok zatrzymuje się na celu.
+        blend = 1.0 - math.exp(-self.speed * delta_time)
+        self.top = self.approach(self.top, self.target_top, blend)
+        self.left = self.approach(self.left, self.target_left, blend)
+
+    def approach(self, value, target, blend):
+        value += (target - value) * blend
+        if abs(target - value) * self.box_size < 1:
+            return float(target)
+        return value
+
+    def jump(self):
+        self.top = float(self.target_top)
+        self.left = float(self.target_left)
+
+    def get_origin(self):
+        first_row = int(self.top)
+        first_col = int(self.left)
+        return (
+            first_row, first_col,
+            int((self.left - first_col) * self.box_size),
+            int((self.top - first_row) * self.box_size))
+
+
+AnimationState = collections.namedtuple(
+    'AnimationState',
+    ['kinds', 'elapsed', 'durations', 'counts', 'cleared_rows', 'cell_rows',
+     'cell_cols', 'cell_colors', 'colors', 'active'])
+
+
+class BoardAnimations:
+
+    def __init__(self, board, slots=ANIMATION_SLOTS):
+        # Stan animacji trzymany jest w tablicach przydzielonych raz,
+        # więc ani aktualizacja, ani rysowanie nie tworzą obiektów.
+        self.board = board
+        self.slots = slots
+        self.kinds = bytearray(slots)
+        self.elapsed = array.array('d', [0.0]) * slots
+        self.durations = array.array('d', [0.0]) * slots
+        self.cleared_rows = (
+            array.array('i', [0]) * (slots * ANIMATION_MAX_ROWS))
+        self.counts = array.array('i', [0]) * slots
+        self.cell_rows = array.array('i', [0]) * (slots * ANIMATION_MAX_CELLS)
+        self.cell_cols = array.array('i', [0]) * (slots * ANIMATION_MAX_CELLS)
+        self.cell_colors = bytearray(slots * ANIMATION_MAX_CELLS)
+        self.row_size = ANIMATION_MAX_ROWS * board.block_end_col
+        self.colors = bytearray(slots * self.row_size)
+        self.active = 0
+        board.add_listener('CLEAR', self.on_clear)
+        board.add_lock_listener(self.on_lock)
+        board.add_listener('RESTORE', self.on_restore)
+
+    def take_slot(self, kind, duration):
+        slot = self.kinds.find(0)
+        if slot < 0:
+            # Brak wolnego miejsca: zastępowana jest najstarsza animacja.
+            slot = max(range(self.slots),
+                       key=lambda index: self.elapsed[index])
+        else:
+            self.active += 1
+        self.kinds[slot] = kind
+        self.elapsed[slot] = 0.0
+        self.durations[slot] = duration
+        return slot
+
+    def on_clear(self, rows):
+        self.shift_lock_cells(rows)
+        rows = rows[-ANIMATION_MAX_ROWS:]
+        slot = self.take_slot(
+            ANIMATION_CLEAR, LINE_FLASH_TIME + LINE_COLLAPSE_TIME)
+        self.counts[slot] = len(rows)
+        board = self.board
+        cols = board.block_end_col
+        offset = slot * self.row_size
+        for index, row in enumerate(rows):
+            self.cleared_rows[slot * ANIMATION_MAX_ROWS + index] = row
+            for col, box in enumerate(board.static_boxes.rows[row]):
+                self.colors[offset + col] = board.get_color_index(box.color)
+            offset += cols
+
+    def on_lock(self):
+        block = self.board.locked_block
+        if block is None:
+            return
+        slot = self.take_slot(ANIMATION_LOCK, LOCK_FLASH_TIME)
+        count = 0
+        offset = slot * ANIMATION_MAX_CELLS
+        for box in block.boxes[:ANIMATION_MAX_CELLS]:
+            # Pola usunięte razem z pełną linią nie błyskają.
+            row = self.board.static_boxes.rows.get(box.row)
+            if row is not None and row[box.col] is box:
+                self.cell_rows[offset + count] = box.row
+                self.cell_cols[offset + count] = box.col
+                self.cell_colors[offset + count] = (
+                    self.board.get_color_index(box.color))
+                count += 1
+        self.counts[slot] = count
+
+    def shift_lock_cells(self, rows):
+        # Błyskające pola z usuniętych linii znikają, a pola nad nimi
+        # opadają razem z resztą planszy.
+        for slot in range(self.slots):
+            if self.kinds[slot] != ANIMATION_LOCK:
+                continue
+            offset = slot * ANIMATION_MAX_CELLS
+            count = 0
+            for index in range(offset, offset + self.counts[slot]):
+                row = self.cell_rows[index]
+                if row in rows:
+                    continue
+                below = 0
+                for cleared in rows:
+                    if cleared > row:
+                        below += 1
+                self.cell_rows[offset + count] = row + below
+                self.cell_cols[offset + count] = self.cell_cols[index]
+                self.cell_colors[offset + count] = self.cell_colors[index]
+                count += 1
+            self.counts[slot] = count
+
+    def on_restore(self, snapshot):
+        self.kinds[:] = bytes(self.slots)
+        self.active = 0
+
+    def update(self, delta_time):
+        if not self.active:
+            return
+        for slot in range(self.slots):
+            if self.kinds[slot]:
+                self.elapsed[slot] += delta_time
+                if self.elapsed[slot] >= self.durations[slot]:
+                    self.kinds[slot] = 0
+                    self.active -= 1
+
+    def take_snapshot(self):
+        # Kopia dla wątku rysowania, gdy symulacja działa w osobnym wątku.
+        return AnimationState(
+            bytes(self.kinds), self.elapsed[:], self.durations[:],
+            self.counts[:], self.cleared_rows[:], self.cell_rows[:],
+            self.cell_cols[:], bytes(self.cell_colors), bytes(self.colors),
+            self.active)
+
+    def render(self, painter, state):
+        # Stanem jest ta sama animacja albo jej kopia z migawki planszy.
+        if not state.active:
+            return
+        board = self.board
+        painter.set_clip(board.x, board.y, board.w, board.h)
+        for slot in range(self.slots):
+            kind = state.kinds[slot]
+            if kind == ANIMATION_CLEAR:
+                self.render_clear(painter, state, slot)
+            elif kind == ANIMATION_LOCK:
+                self.render_lock(painter, state, slot)
+        painter.reset_clip()
+
+    def render_clear(self, painter, state, slot):
+        # Najpierw wyczyszczone linie migają w swoim miejscu, potem
+        # wiersze nad nimi płynnie opadają. Linie nie muszą sąsiadować,
+        # więc każdy pas wierszy opada o liczbę usuniętych linii pod nim.
+        board = self.board
+        count = state.counts[slot]
+        elapsed = state.elapsed[slot]
+        if elapsed < LINE_FLASH_TIME:
+            fall = 1.0
+        else:
+            progress = (elapsed - LINE_FLASH_TIME) / LINE_COLLAPSE_TIME
+            fall = 1 - progress * progress * (3 - 2 * progress)
+        if int(board.box_size * fall) <= 0:
+            return
+        start = slot * ANIMATION_MAX_ROWS
+        board.render_background_rows(
+            painter, state.cleared_rows[start + count - 1])
+        above = -1
+        for index in range(count):
+            cleared = state.cleared_rows[start + index]
+            below = count - index
+            board.render_shifted_rows(
+                painter, above + 1 + below, cleared - 1 + below,
+                int(below * board.box_size * fall))
+            above = cleared
+        if elapsed >= LINE_FLASH_TIME:
+            return
+        blink = int(elapsed / LINE_BLINK_TIME) % 2 == 0
+        offset = slot * self.row_size
+        for index in range(count):
+            row = state.cleared_rows[start + index]
+            for col in range(board.block_end_col):
+                if blink:
+                    color = COLOR_FLASH
+                else:
+                    color = board.palette[state.colors[offset + col]]
+                board.render_cell(painter, row, col, color, False)
+            offset += board.block_end_col
+
+    def render_lock(self, painter, state, slot):
+        board = self.board
+        fade = 1 - state.elapsed[slot] / state.durations[slot]
+        offset = slot * ANIMATION_MAX_CELLS
+        for index in range(offset, offset + state.counts[slot]):
+            color = tuple(
+                int(value + (flash - value) * fade)
+                for value, flash in zip(
+                    board.palette[state.cell_colors[index]], COLOR_FLASH))
+            board.render_cell(
+                painter, state.cell_rows[index], state.cell_cols[index],
+                color, False)
+
+
+class Board:
+
+    def __init__(self, block_factories, get_level, seed=None,
+                 geometry=BOARD_GEOMETRY, rows=None, cols=None):
+        self.x, self.y, self.w, self.h = geometry
+        rows = rows or BOARD_ROWS
+        cols = cols or BOARD_COLS
+        # Duża plansza nie mieści się w oknie, więc rysowany jest tylko
+        # widoczny fragment z mniejszymi polami.
+        self.box_size = max(MIN_BOX_SIZE, min(BOX_SIZE, self.w // cols))
+        self.view_rows = min(rows, self.h // self.box_size)
+        self.view_cols = min(cols, self.w // self.box_size)
+        self.w = self.view_cols * self.box_size
+        self.h = self.view_rows * self.box_size
+        self.camera = Camera(
+            rows, cols, self.view_rows, self.view_cols, self.box_size)
+        self.origin = (0, 0, 0, 0)
+        self.block_factories = block_factories
+        self.grid_color = GRID_COLOR
+        self.background_color = COLOR_WHITE
+        self.curr_block = None
+        self.locked_block = None
+        self.next_block = None
+        self.block_start_row = 0
+        self.block_end_row = rows
+        self.block_start_col = 0
+        self.block_end_col = cols
+        self.block_mid_col = cols // 2 - 1
+        self.static_boxes = StaticBoxGroup(
+            self.block_end_row, self.block_end_col)
+        self.game_over = False
         self.game_over_bgcolor = COLOR_BG_GAME_OVER
         self.game_over_block_color = COLOR_BLOCK_GAME_OVER
         self.paused = False
         self.get_level = get_level
         self.event_emitter = EventEmitter()
+        self.snapshot_buffer = None
+        self.get_snapshot_counters = None
+        self.snapshot_static_cells = ()
+        self.snapshot_version = None
+        self.drop_distance_key = None
+        self.drop_distance = 0
+        self.snapshot_key = None
+        self.static_layer = None
+        self.static_layer_key = None
+        self.animations = None
+        self.random = random.Random(seed)
+        self.palette = [None]
+        self.palette_index = {}
+        for factory in block_factories:
+            self.get_color_index(factory.color)
 
     def add_listener(self, event, listener):
         self.event_emitter.add_listener(event, listener)
@@ -914,6 +2668,9 @@ class Board:
     def add_game_over_listener(self, listener):
         self.event_emitter.add_listener('GAME_OVER', listener)
 
+    def add_lock_listener(self, listener):
+        self.event_emitter.add_listener('LOCK', listener)
+
     def get_state(self):
         if self.curr_block:
             return {
@@ -939,43 +2696,228 @@ class Board:
     def set_direction(self, direction):
         if self.curr_block and not self.paused:
             if self.curr_block.direction != direction:
+                self.event_emitter.emit('INPUT', direction or 'STOP')
                 self.curr_block.direction = direction
 
     def rotate_curr_block(self):
         if self.curr_block and not self.paused:
+            self.event_emitter.emit('INPUT', 'ROTATE')
             self.curr_block.want_rotate = True
 
-    def render(self, painter):
-        if self.game_over:
-            bgcolor = self.game_over_bgcolor
+    def drop_curr_block(self):
+        if self.curr_block and not self.paused:
+            self.event_emitter.emit('INPUT', 'DROP')
+            self.curr_block.want_drop = True
+
+    def get_drop_distance(self):
+        block = self.curr_block
+        anchor = block.boxes[0]
+        key = (id(block), self.static_boxes.version, block.rotate_position,
+               anchor.row, anchor.col)
+        if key != self.drop_distance_key:
+            self.drop_distance_key = key
+            self.drop_distance = self.compute_drop_distance(block)
+        return self.drop_distance
+
+    def compute_drop_distance(self, block):
+        distance = self.block_end_row
+        for box in block.boxes:
+            drop_row = self.static_boxes.get_landing_row(box.row, box.col)
+            distance = min(distance, drop_row - box.row)
+        return max(distance, 0)
+
+    def enable_snapshots(self, get_counters=None):
+        self.snapshot_buffer = SnapshotBuffer()
+        self.get_snapshot_counters = get_counters
+        self.publish_snapshot()
+
+    def read_snapshot(self):
+        if self.snapshot_buffer is None:
+            return None
+        return self.snapshot_buffer.read()
+
+    def get_next_cells(self):
+        if self.next_block is None:
+            return ()
+        return tuple(
+            (box.row, box.col, box.color) for box in self.next_block.boxes)
+
+    def enable_animations(self):
+        self.animations = BoardAnimations(self)
+
+    def make_snapshot(self):
+        if self.snapshot_version != self.static_boxes.version:
+            self.snapshot_version = self.static_boxes.version
+            self.snapshot_static_cells = tuple(
+                (box.row, box.col, box.color)
+                for box in self.static_boxes.boxes)
+        if self.curr_block:
+            curr_cells = tuple(
+                (box.row, box.col, box.color) for box in self.curr_block.boxes)
+            ghost_distance = self.get_drop_distance()
         else:
-            bgcolor = self.background_color
+            curr_cells = ()
+            ghost_distance = 0
+        counters = ()
+        if self.get_snapshot_counters is not None:
+            counters = self.get_snapshot_counters()
+        animations = None
+        if self.animations is not None and self.animations.active:
+            animations = self.animations.take_snapshot()
+        return BoardSnapshot(
+            self.snapshot_static_cells, curr_cells, ghost_distance,
+            self.game_over, self.get_next_cells(), self.camera.get_origin(),
+            counters, animations)
+
+    def publish_snapshot(self):
+        self.snapshot_buffer.publish(self.make_snapshot())
+
+    def render(self, painter):
+        if self.snapshot_buffer is not None:
+            self.render_snapshot(painter, self.snapshot_buffer.read())
+            return
 
-        painter.fill_rect(self.x, self.y, self.w, self.h, bgcolor)
-        self.render_static_boxes(painter)
+        self.origin = self.camera.get_origin()
+        self.render_static_layer(
+            painter, (self.static_boxes.version, self.game_over),
+            self.render_static_boxes, self.game_over)
+        if self.animations is not None:
+            self.animations.render(painter, self.animations)
 
         if self.curr_block:
+            painter.set_clip(self.x, self.y, self.w, self.h)
+            self.render_ghost_block(painter)
             self.render_curr_block(painter)
-
-        # net
-        self.render_net_lines(painter)
+            painter.reset_clip()
+
+    def render_snapshot(self, painter, snapshot):
+        def render_static_cells(layer):
+            for row, col, color in snapshot.static_cells:
+                self.render_cell(layer, row, col, color, snapshot.game_over)
+
+        self.origin = snapshot.origin
+        self.render_static_layer(
+            painter, (snapshot.static_cells, snapshot.game_over),
+            render_static_cells, snapshot.game_over)
+        if snapshot.animations is not None:
+            self.animations.render(painter, snapshot.animations)
+        painter.set_clip(self.x, self.y, self.w, self.h)
+        for row, col, color in snapshot.curr_cells:
+            self.render_ghost_cell(
+                painter, row + snapshot.ghost_distance, col, color)
+            self.render_cell(painter, row, col, color, snapshot.game_over)
+            self.render_cell_grid(painter, row, col)
+        painter.reset_clip()
+
+    def get_cell_position(self, row, col):
+        # Pozycja pola w oknie albo None, gdy pole jest poza widokiem.
+        first_row, first_col, offset_x, offset_y = self.origin
+        x = (col - first_col) * self.box_size - offset_x
+        y = (row - first_row) * self.box_size - offset_y
+        size = self.box_size
+        if -size < x < self.w + size and -size < y < self.h + size:
+            return self.x + x, self.y + y
+        return None
+
+    def render_static_layer(self, painter, key, render_cells, game_over):
+        # Tło, leżące klocki i siatka zmieniają się tylko przy położeniu
+        # klocka albo przewinięciu widoku o całe pole, więc są rysowane raz
+        # do osobnej powierzchni, o jedno pole większej przy przewijaniu.
+        first_row, first_col, offset_x, offset_y = self.origin
+        if self.static_layer is None:
+            self.static_layer = painter.create_layer(
+                self.x, self.y,
+                self.w + self.box_size * (self.camera.max_left > 0),
+                self.h + self.box_size * (self.camera.max_top > 0))
+        key = (key, first_row, first_col)
+        if self.static_layer_key != key:
+            self.static_layer_key = key
+            self.origin = (first_row, first_col, 0, 0)
+            self.render_background(self.static_layer, game_over)
+            render_cells(self.static_layer)
+            self.render_net_lines(self.static_layer)
+            self.origin = (first_row, first_col, offset_x, offset_y)
+        self.static_layer.render(
+            painter, (offset_x, offset_y, self.w, self.h))
         painter.draw_rect(self.x, self.y, self.w, self.h, self.grid_color)
 
+    def render_shifted_rows(self, painter, top_row, bottom_row, shift):
+        # Wiersze top_row..bottom_row z warstwy rysowane są wyżej
+        # o shift pikseli.
+        first_row, _, offset_x, offset_y = self.origin
+        top = max((top_row - first_row) * self.box_size - offset_y, 0)
+        bottom = min(
+            (bottom_row + 1 - first_row) * self.box_size - offset_y, self.h)
+        if bottom <= top:
+            return
+        painter.blit(
+            self.static_layer.screen, self.x, self.y + top - shift,
+            (offset_x, offset_y + top, self.w, bottom - top))
+
+    def render_background_rows(self, painter, bottom_row):
+        first_row, _, _, offset_y = self.origin
+        bottom = min(
+            (bottom_row + 1 - first_row) * self.box_size - offset_y, self.h)
+        if bottom > 0:
+            painter.fill_rect(
+                self.x, self.y, self.w, bottom, self.background_color)
+
+    def render_background(self, painter, game_over):
+        if game_over:
+            bgcolor = self.game_over_bgcolor
+        else:
+            bgcolor = self.background_color
+        painter.fill_rect(
+            self.x, self.y, painter.width, painter.height, bgcolor)
+
     def render_static_boxes(self, painter):
-        for box in self.static_boxes.boxes:
-            self.render_box(painter, box)
+        first_row, first_col, _, _ = self.origin
+        last_col = first_col + self.view_cols + 1
+        for _, row in self.static_boxes.iter_rows(
+                first_row, first_row + self.view_rows + 1):
+            for box in row[first_col:last_col]:
+                if box is not None:
+                    self.render_box(painter, box)
 
     def render_curr_block(self, painter):
         for box in self.curr_block.boxes:
             self.render_box(painter, box)
+            self.render_cell_grid(painter, box.row, box.col)
+
+    def render_ghost_block(self, painter):
+        distance = self.get_drop_distance()
+        for box in self.curr_block.boxes:
+            self.render_ghost_cell(
+                painter, box.row + distance, box.col, box.color)
+            self.render_cell_grid(painter, box.row + distance, box.col)
+
+    def render_cell_grid(self, painter, row, col):
+        position = self.get_cell_position(row, col)
+        if position is None:
+            return
+        box_x, box_y = position
+        painter.draw_rect(
+            box_x, box_y,
+            min(self.box_size + 1, self.x + self.w - box_x),
+            min(self.box_size + 1, self.y + self.h - box_y),
+            self.grid_color)
+
+    def render_ghost_cell(self, painter, row, col, color):
+        position = self.get_cell_position(row, col)
+        if position is not None:
+            painter.draw_rect(
+                position[0], position[1], self.box_size, self.box_size, color)
 
     def render_box(self, painter, box):
-        box_x = self.x + box.col * self.box_size
-        box_y = self.y + box.row * self.box_size
-        if self.game_over:
+        self.render_cell(painter, box.row, box.col, box.color, self.game_over)
+
+    def render_cell(self, painter, row, col, color, game_over):
+        position = self.get_cell_position(row, col)
+        if position is None:
+            return
+        box_x, box_y = position
+        if game_over:
             color = self.game_over_block_color
-        else:
-            color = box.color
         painter.fill_rect(
             box_x, box_y, self.box_size, self.box_size, color)
 
@@ -984,14 +2926,14 @@ class Board:
         self.render_horizontal_net_lines(painter)
 
     def render_vertical_net_lines(self, painter):
-        for x in range(self.x, self.x + self.w, self.box_size):
+        for x in range(self.x, self.x + painter.width, self.box_size):
             painter.draw_line(
-                x, self.y, x, self.y + self.h - 1, self.grid_color)
+                x, self.y, x, self.y + painter.height - 1, self.grid_color)
 
     def render_horizontal_net_lines(self, painter):
-        for y in range(self.y, self.y + self.h, self.box_size):
+        for y in range(self.y, self.y + painter.height, self.box_size):
             painter.draw_line(
-                self.x, y, self.x + self.w - 1, y, self.grid_color)
+                self.x, y, self.x + painter.width - 1, y, self.grid_color)
 
     def take_next_block(self):
         block = self.next_block
@@ -999,11 +2941,50 @@ class Board:
         return block
 
     def create_random_block(self):
-        factory = random.choice(self.block_factories)
+        factory = self.random.choice(self.block_factories)
+        return self.create_block(factory)
+
+    def create_block(self, factory):
         boxes = self.create_boxes(factory.required_boxes, factory.color)
         block = factory.create(boxes)
         return block
 
+    def get_factory(self, kind):
+        for factory in self.block_factories:
+            if factory.kind == kind:
+                return factory
+        return None
+
+    def get_color_index(self, color):
+        color = tuple(color)
+        index = self.palette_index.get(color)
+        if index is None:
+            index = len(self.palette)
+            self.palette.append(color)
+            self.palette_index[color] = index
+        return index
+
+    def take_compact_snapshot(self, scores=0, lines=0):
+        if self.next_block is None:
+            next_kind = None
+        else:
+            next_kind = self.next_block.kind
+        return CompactSnapshot(
+            self.static_boxes.pack_cells(self.get_color_index), next_kind,
+            pack_rng_state(self.random), scores, lines)
+
+    def restore_compact_snapshot(self, snapshot):
+        self.static_boxes.unpack_cells(snapshot.cells, self.palette, self)
+        self.curr_block = None
+        if snapshot.next_kind is None:
+            self.next_block = None
+        else:
+            self.next_block = self.create_block(
+                self.get_factory(snapshot.next_kind))
+        unpack_rng_state(self.random, snapshot.rng_state)
+        self.game_over = False
+        self.event_emitter.emit('RESTORE', snapshot)
+
     def create_boxes(self, box_count, color):
         boxes = []
         for _ in range(box_count):
@@ -1012,9 +2993,13 @@ class Board:
         boxes[0].col = self.block_mid_col
         return boxes
 
-    def get_curr_block(self):
+    def get_next_block(self):
         if self.next_block is None:
             self.next_block = self.create_random_block()
+        return self.next_block
+
+    def get_curr_block(self):
+        self.get_next_block()
 
         if self.curr_block is None:
             self.curr_block = self.take_next_block()
@@ -1022,21 +3007,48 @@ class Board:
         return self.curr_block
 
     def stop_curr_block(self):
+        self.locked_block = self.curr_block
         self.curr_block = None
 
     def toggle_pause(self):
+        self.event_emitter.emit('INPUT', 'PAUSE')
         self.paused = not self.paused
 
     def update(self, delta_time):
+        self.event_emitter.emit('TICK', delta_time)
+        self.simulate(delta_time)
+        if self.curr_block is not None:
+            anchor = self.curr_block.boxes[0]
+            self.camera.follow(anchor.row, anchor.col)
+        self.camera.update(delta_time)
+        if self.animations is not None:
+            self.animations.update(delta_time)
+        if self.snapshot_buffer is not None:
+            # Trwająca animacja zmienia obraz w każdym takcie.
+            snapshot_key = (
+                self.get_zobrist(), self.game_over,
+                self.next_block and self.next_block.kind,
+                self.camera.get_origin(),
+                self.get_snapshot_counters and self.get_snapshot_counters(),
+                self.animations and self.animations.active)
+            if (snapshot_key != self.snapshot_key or
+                    self.animations is not None and self.animations.active):
+                self.snapshot_key = snapshot_key
+                self.publish_snapshot()
+
+    def get_zobrist(self):
+        if self.curr_block is None:
+            return self.static_boxes.zobrist
+        return self.static_boxes.zobrist ^ self.curr_block.get_zobrist()
+
+    def simulate(self, delta_time):
         if self.game_over or self.paused:
             return
 
         curr_block = self.get_curr_block()
 
         if curr_block.want_rotate:
-            rotated_block = curr_block.make_rotated()
-            if not self.has_any_collision(rotated_block):
-                curr_block.rotate()
+            if curr_block.rotate_with_kicks(self.has_any_collision):
                 self.event_emitter.emit('SOUND', 'rotate')
             curr_block.want_rotate = False
 
@@ -1052,10 +3064,15 @@ class Board:
             while self.static_boxes.has_collision(curr_block):
                 self.curr_block.move_one_left()
 
-        curr_block.vertical_update(delta_time, self.get_level())
-
         stop_curr_block = False
 
+        if curr_block.want_drop:
+            curr_block.move_down(self.get_drop_distance())
+            curr_block.want_drop = False
+            stop_curr_block = True
+        else:
+            curr_block.vertical_update(delta_time, self.get_level())
+
         if self.is_bottom_border_collision(curr_block):
             curr_block.move_one_up()
             while self.is_bottom_border_collision(curr_block):
@@ -1074,17 +3091,37 @@ class Board:
             self.stop_curr_block()
             self.event_emitter.emit('SOUND', 'stop')
 
+        full_rows = self.static_boxes.full_rows
+        if full_rows:
+            self.event_emitter.emit('CLEAR', sorted(full_rows))
         lines = self.static_boxes.clear_full_rows()
         if lines > 0:
             self.event_emitter.emit(EVENT_FULL_LINES, lines)
             self.event_emitter.emit('SOUND', 'line')
 
+        if stop_curr_block:
+            self.event_emitter.emit('LOCK')
+
     def check_game_over(self):
         box = self.curr_block.get_top_box()
         if box.row < 0:
             self.game_over = True
             self.event_emitter.emit('GAME_OVER')
 
+    def shift_curr_block(self, cols):
+        self.event_emitter.emit(
+            'INPUT', 'SHIFT_RIGHT' if cols > 0 else 'SHIFT_LEFT')
+        block = self.curr_block
+        if block is None or self.paused:
+            return False
+        for box in block.boxes:
+            box.col += cols
+        if self.has_any_collision(block):
+            for box in block.boxes:
+                box.col -= cols
+            return False
+        return True
+
     def has_any_collision(self, block):
         return (
             self.has_left_border_collision(block) or
@@ -1120,25 +3157,112 @@ class Board:
         return box.row >= self.block_end_row
 
 
+class PieceShape:
+
+    def __init__(self, kind, color, cells, pivot=1, rotations=4, turn='cw',
+                 kicks=((0, 0),)):
+        self.kind = kind
+        self.color = tuple(color)
+        self.size = len(cells)
+        self.pivot = pivot
+        pivot_row, pivot_col = cells[pivot]
+        self.spawn_cells = tuple(
+            (row - cells[0][0], col - cells[0][1]) for row, col in cells)
+        state = tuple(
+            (row - pivot_row, col - pivot_col) for row, col in cells)
+        states = []
+        for _ in range(rotations):
+            states.append(state)
+            if turn == 'cw':
+                state = tuple((col, -row) for row, col in state)
+            else:
+                state = tuple((-col, row) for row, col in state)
+        self.states = tuple(states)
+        self.kicks = tuple(tuple(kick) for kick in kicks)
+
+        self.top_index = tuple(
+            min(range(self.size), key=lambda i: offsets[i][0])
+            for offsets in self.states)
+        self.bottom_index = tuple(
+            max(range(self.size), key=lambda i: offsets[i][0])
+            for offsets in self.states)
+        self.left_index = tuple(
+            min(range(self.size), key=lambda i: offsets[i][1])
+            for offsets in self.states)
+        self.right_index = tuple(
+            max(range(self.size), key=lambda i: offsets[i][1])
+            for offsets in self.states)
+        self.bounds = tuple(
+            (min(row for row, _ in offsets), max(row for row, _ in offsets),
+             min(col for _, col in offsets), max(col for _, col in offsets))
+            for offsets in self.states)
+        self.bottom_profiles = tuple(
+            get_bottom_profile(offsets) for offsets in self.states)
+        self.normalized = tuple(
+            normalize_cells(offsets) for offsets in self.states)
+
+    def infer_rotation(self, cells):
+        # Stare zapisy nie mają obrotu ani kolejności klocków z tabel.
+        for rotation, offsets in enumerate(self.states):
+            if normalize_cells(cells) != self.normalized[rotation]:
+                continue
+            min_row = min(row for row, _ in cells)
+            min_col = min(col for _, col in cells)
+            origin_row = min_row - self.bounds[rotation][0]
+            origin_col = min_col - self.bounds[rotation][2]
+            order = [cells.index((origin_row + row, origin_col + col))
+                     for row, col in offsets]
+            return rotation, order
+        return 0, list(range(len(cells)))
+
+
+def get_bottom_profile(offsets):
+    profile = {}
+    for index, (row, col) in enumerate(offsets):
+        if col not in profile or row > offsets[profile[col]][0]:
+            profile[col] = index
+    return tuple(profile[col] for col in sorted(profile))
+
+
+@functools.lru_cache(maxsize=None)
+def load_piece_shapes(path):
+    with open(path) as document:
+        data = json.load(document)
+    shapes = []
+    for piece in data['pieces']:
+        if len(piece['kind']) != 1:
+            raise ValueError('piece kind must be one character')
+        shapes.append(PieceShape(
+            piece['kind'], piece['color'],
+            [tuple(cell) for cell in piece['cells']],
+            piece.get('pivot', 1), piece.get('rotations', 4),
+            piece.get('turn', 'cw'), piece.get('kicks', [[0, 0]])))
+    return tuple(shapes)
+
+
 class BlockFactory:
 
-    def __init__(self, box_class, color, box_size, gravity_speed, player_speed):
-        self.box_class = box_class
-        self.color = color
+    def __init__(self, shape, box_size, gravity_speed, player_speed):
+        self.shape = shape
+        self.color = shape.color
         self.box_size = box_size
         self.gravity_speed = gravity_speed
         self.player_speed = player_speed
-        self.kind = box_class.kind
-        self.required_boxes = box_class.required_boxes
+        self.kind = shape.kind
+        self.required_boxes = shape.size
 
-    def create(self, boxes, prepared_boxes=False):
-        return self.box_class(boxes, self, prepared_boxes)
+    def create(self, boxes, prepared_boxes=False, rotate_position=0):
+        return Block(boxes, self, prepared_boxes, rotate_position)
 
 
 class Block:
 
-    def __init__(self, boxes, factory, prepared_boxes=False):
+    def __init__(self, boxes, factory, prepared_boxes=False,
+                 rotate_position=0):
         self.factory = factory
+        self.shape = factory.shape
+        self.kind = factory.kind
+        self.max_rotate_positions = len(self.shape.states)
         self.acc_row = UnitAccumulator(factory.box_size)
         self.acc_col = UnitAccumulator(factory.box_size)
         self.direction = None
@@ -1146,7 +3270,8 @@ class Block:
             self.prepare_boxes(boxes)
         self.boxes = boxes
         self.want_rotate = False
-        self.rotate_position = 0
+        self.want_drop = False
+        self.rotate_position = rotate_position
 
     @classmethod
     def from_state(cls, state, factories, board):
@@ -1156,31 +3281,74 @@ class Block:
                 curr_factory = factory
 
         boxes = [Box.from_state(board, state) for state in state['boxes']]
-        return curr_factory.create(boxes, True)
+        if 'rotation' in state:
+            rotation = state['rotation']
+        else:
+            rotation, order = curr_factory.shape.infer_rotation(
+                [(box.row, box.col) for box in boxes])
+            boxes = [boxes[index] for index in order]
+        return curr_factory.create(boxes, True, rotation)
 
     def get_state(self):
         return {
             'kind': self.kind,
+            'rotation': self.rotate_position,
             'boxes': [box.get_state() for box in self.boxes]
         }
 
+    def get_zobrist(self):
+        anchor = self.boxes[0]
+        return (zobrist_key(ZOBRIST_PIECE, ord(self.kind),
+                            self.rotate_position) ^
+                zobrist_key(ZOBRIST_POSITION, anchor.row, anchor.col))
+
     def prepare_boxes(self, boxes):
-        raise NotImplemented()
+        row = boxes[0].row
+        col = boxes[0].col
+        for box, (delta_row, delta_col) in zip(
+                boxes, self.shape.spawn_cells):
+            box.row = row + delta_row
+            box.col = col + delta_col
 
     def get_top_box(self):
-        raise NotImplemented()
+        return self.boxes[self.shape.top_index[self.rotate_position]]
 
     def get_left_box(self):
-        raise NotImplemented()
+        return self.boxes[self.shape.left_index[self.rotate_position]]
 
     def get_right_box(self):
-        raise NotImplemented()
+        return self.boxes[self.shape.right_index[self.rotate_position]]
 
     def get_bottom_box(self):
-        raise NotImplemented()
+        return self.boxes[self.shape.bottom_index[self.rotate_position]]
 
     def get_bottom_boxes(self):
-        raise NotImplemented()
+        return [self.boxes[index] for index in
+                self.shape.bottom_profiles[self.rotate_position]]
+
+    def place(self, rotate_position, pivot_row, pivot_col):
+        self.rotate_position = rotate_position
+        for box, (delta_row, delta_col) in zip(
+                self.boxes, self.shape.states[rotate_position]):
+            box.row = pivot_row + delta_row
+            box.col = pivot_col + delta_col
+
+    def rotate(self, kick=(0, 0)):
+        pivot = self.boxes[self.shape.pivot]
+        self.place(
+            (self.rotate_position + 1) % self.max_rotate_positions,
+            pivot.row + kick[0], pivot.col + kick[1])
+
+    def rotate_with_kicks(self, has_collision):
+        rotate_position = self.rotate_position
+        pivot = self.boxes[self.shape.pivot]
+        pivot_row, pivot_col = pivot.row, pivot.col
+        for kick in self.shape.kicks:
+            self.rotate(kick)
+            if not has_collision(self):
+                return True
+            self.place(rotate_position, pivot_row, pivot_col)
+        return False
 
     def copy_boxes(self):
         return [copy.copy(box) for box in self.boxes]
@@ -1215,6 +3383,10 @@ class Block:
         for box in self.boxes:
             box.row -= 1
 
+    def move_down(self, rows):
+        for box in self.boxes:
+            box.row += rows
+
     def calculate_total_gravity(self, level):
         if self.direction == 'DOWN':
             return self.factory.gravity_speed(level) + self.factory.player_speed
@@ -1222,615 +3394,1806 @@ class Block:
             return self.factory.gravity_speed(level)
 
 
-class LongBlock(Block):
-    required_boxes = 4
-    max_rotate_positions = 2
-    kind = '|'
+class UnitAccumulator:
 
-    def prepare_boxes(self, boxes):
-        row = boxes[0].row
-        col = boxes[0].col
-        for box in boxes[1:]:
-            row += 1
-            box.row = row
-            box.col = col
+    def __init__(self, unit):
+        self.real_value = 0
+        self.unit = unit
 
-    def is_vertical(self):
-        return self.rotate_position == 0
+    def inc(self, delta):
+        self.real_value += delta
 
-    def get_top_box(self):
-        return self.boxes[0]
+    def take_value(self):
+        value = self.real_value // self.unit
+        if value:
+            self.real_value -= value * self.unit
+        return int(value)
 
-    def get_bottom_box(self):
-        return self.boxes[-1]
 
-    def get_left_box(self):
-        return self.boxes[0]
+class PlacementSearch:
 
-    def get_right_box(self):
-        if self.is_vertical():
-            return self.boxes[0]
-        else:
-            return self.boxes[-1]
+    def __init__(self, row_count, col_count, weights=AI_WEIGHTS,
+                 cache_size=AI_CACHE_SIZE):
+        self.row_count = row_count
+        self.col_count = col_count
+        self.full_row = (1 << col_count) - 1
+        self.weights = weights
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def find_best(self, grid, grid_hash, features, shapes, next_kind=None,
+                  next_shapes=None):
+        best_score = None
+        best_placement = None
+        for rotations, cells in shapes:
+            for col, placed in self.get_drops(features.tops, cells):
+                full_rows = self.get_full_rows(grid, placed)
+                filled, result = self.place(grid, placed, full_rows)
+                result_features = self.apply_features(
+                    features, filled, placed, full_rows)
+                score = self.weights['lines'] * len(full_rows)
+                if next_shapes:
+                    score += self.get_best_score(
+                        result,
+                        self.get_result_hash(
+                            grid_hash, result, placed, full_rows),
+                        result_features, next_kind, next_shapes)
+                else:
+                    score += self.evaluate(result_features)
+                if best_score is None or score > best_score:
+                    best_score = score
+                    best_placement = (rotations, col)
+        return best_placement
+
+    def get_best_score(self, grid, grid_hash, features, kind, shapes):
+        key = grid_hash ^ zobrist_key(ZOBRIST_PIECE, ord(kind), 0)
+        score = self.lookup(key)
+        if score is not None:
+            return score
+        best_score = None
+        for _, cells in shapes:
+            for _, placed in self.get_drops(features.tops, cells):
+                full_rows = self.get_full_rows(grid, placed)
+                if full_rows:
+                    filled, _ = self.place(grid, placed, full_rows)
+                    score = self.evaluate(self.apply_features(
+                        features, filled, placed, full_rows))
+                else:
+                    # Bez pełnych linii wystarczy poprawić cechy o zmianę
+                    # w kolumnach klocka, bez kopiowania planszy i cech.
+                    score = self.evaluate_drop(features, placed)
+                score += self.weights['lines'] * len(full_rows)
+                if best_score is None or score > best_score:
+                    best_score = score
+        if best_score is None:
+            best_score = float('-inf')
+        self.store(key, best_score)
+        return best_score
+
+    def get_drops(self, tops, cells):
+        width = max(col for _, col in cells) + 1
+        for col in range(self.col_count - width + 1):
+            row = min(tops[col + cell_col] - cell_row - 1
+                      for cell_row, cell_col in cells)
+            if row >= 0:
+                yield col, [(row + cell_row, col + cell_col)
+                            for cell_row, cell_col in cells]
+
+    def get_full_rows(self, grid, placed):
+        masks = {}
+        for row, col in placed:
+            masks[row] = masks.get(row, grid[row]) | 1 << col
+        return sorted(
+            row for row, mask in masks.items() if mask == self.full_row)
+
+    def place(self, grid, placed, full_rows):
+        filled = list(grid)
+        for row, col in placed:
+            filled[row] |= 1 << col
+        result = filled
+        if full_rows:
+            result = filled[:]
+            for full_row in full_rows:
+                del result[full_row]
+                result.insert(0, 0)
+        return filled, result
+
+    def get_result_hash(self, grid_hash, result, placed, full_rows):
+        if full_rows:
+            return zobrist_grid(result)
+        for row, col in placed:
+            grid_hash ^= zobrist_key(ZOBRIST_CELL, row, col)
+        return grid_hash
+
+    def apply_features(self, features, filled, placed, full_rows):
+        def is_filled(row, col):
+            return filled[row] >> col & 1
+
+        result_features = features.copy()
+        result_features.add_cells(placed, is_filled)
+        for full_row in full_rows:
+            result_features.remove_full_row(full_row, is_filled)
+        return result_features
+
+    def evaluate_drop(self, features, placed):
+        tops = features.tops
+        new_tops = {}
+        counts = {}
+        for row, col in placed:
+            new_tops[col] = min(new_tops.get(col, tops[col]), row)
+            counts[col] = counts.get(col, 0) + 1
+        height = features.aggregate_height
+        holes = features.total_holes
+        bumpiness = features.bumpiness
+        pairs = set()
+        for col, top in new_tops.items():
+            height += tops[col] - top
+            holes += tops[col] - top - counts[col]
+            if col > 0:
+                pairs.add(col - 1)
+            if col < self.col_count - 1:
+                pairs.add(col)
+        for col in pairs:
+            left = new_tops.get(col, tops[col])
+            right = new_tops.get(col + 1, tops[col + 1])
+            bumpiness += abs(left - right) - abs(tops[col] - tops[col + 1])
+        return self.score(height, holes, bumpiness)
+
+    def evaluate(self, features):
+        return self.score(
+            features.aggregate_height, features.total_holes,
+            features.bumpiness)
+
+    def score(self, height, holes, bumpiness):
+        return (
+            self.weights['height'] * height +
+            self.weights['holes'] * holes +
+            self.weights['bumpiness'] * bumpiness
+        )
 
-    def get_bottom_boxes(self):
-        if self.is_vertical():
-            return [self.boxes[-1]]
+    def lookup(self, key):
+        score = self.cache.get(key)
+        if score is None:
+            self.cache_misses += 1
         else:
-            return self.boxes
-
-    def rotate(self):
-        self.rotate_position += 1
-        if self.rotate_position == self.max_rotate_positions:
-            self.rotate_position = 0
-
-        if self.rotate_position == 0:
-            self.use_position_vertical()
-        elif self.rotate_position == 1:
-            self.use_position_horizontal()
-
-    def make_rotated(self):
-        block = LongBlock(self.copy_boxes(), self.factory, prepared_boxes=True)
-        block.rotate_position = self.rotate_position
-        block.rotate()
-        return block
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+        return score
 
-    def use_position_vertical(self):
-        row = self.boxes[1].row - 1
-        col = self.boxes[1].col
-        for box in self.boxes:
-            box.row = row
-            box.col = col
-            row += 1
-
-    def use_position_horizontal(self):
-        row = self.boxes[1].row
-        col = self.boxes[1].col - 1
-        for box in self.boxes:
-            box.row = row
-            box.col = col
-            col += 1
+    def store(self, key, score):
+        self.cache[key] = score
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
 
 
-class TBlock(Block):
-    required_boxes = 4
-    max_rotate_positions = 4
-    kind = 'T'
-
-    def prepare_boxes(self, boxes):
-        boxes[1].row = boxes[0].row + 1
-        boxes[1].col = boxes[0].col
-        boxes[2].row = boxes[0].row + 2
-        boxes[2].col = boxes[0].col
-        boxes[3].row = boxes[0].row + 1
-        boxes[3].col = boxes[0].col + 1
+def get_rotation_shapes(block):
+    shapes = []
+    seen = set()
+    normalized = block.shape.normalized
+    for rotations in range(block.max_rotate_positions):
+        cells = normalized[
+            (block.rotate_position + rotations) % block.max_rotate_positions]
+        if cells not in seen:
+            seen.add(cells)
+            shapes.append((rotations, cells))
+    return tuple(shapes)
 
-    def is_right_position(self):
-        return self.rotate_position == 0
 
-    def is_bottom_position(self):
-        return self.rotate_position == 1
+def normalize_cells(cells):
+    cells = list(cells)
+    min_row = min(row for row, _ in cells)
+    min_col = min(col for _, col in cells)
+    return tuple(sorted((row - min_row, col - min_col) for row, col in cells))
 
-    def is_left_position(self):
-        return self.rotate_position == 2
 
-    def is_top_position(self):
-        return self.rotate_position == 3
+class AutoPlayer:
 
-    def get_top_box(self):
-        if self.is_top_position():
-            return self.boxes[3]
+    def __init__(self, board, search=None):
+        self.board = board
+        if search is None:
+            search = PlacementSearch(board.block_end_row, board.block_end_col)
+        self.search = search
+        self.block = None
+        self.target = None
+
+    def plan(self, block):
+        static_boxes = self.board.static_boxes
+        grid = static_boxes.get_row_masks()
+        features = static_boxes.features
+        shapes = get_rotation_shapes(block)
+        next_block = self.board.next_block
+        if next_block is None:
+            placement = self.search.find_best(
+                grid, static_boxes.zobrist, features, shapes)
         else:
-            return self.boxes[0]
+            placement = self.search.find_best(
+                grid, static_boxes.zobrist, features, shapes,
+                next_block.kind, get_rotation_shapes(next_block))
+        if placement is None:
+            return None
+        rotations, col = placement
+        max_positions = block.max_rotate_positions
+        return (block.rotate_position + rotations) % max_positions, col
 
-    def get_bottom_box(self):
-        if self.is_bottom_position():
-            return self.boxes[3]
+    def update(self, delta_time):
+        board = self.board
+        block = board.curr_block
+        if block is None or board.game_over or board.paused:
+            return
+        if block is not self.block:
+            self.block = block
+            self.target = self.plan(block)
+        if self.target is None:
+            board.drop_curr_block()
+            return
+        rotate_position, col = self.target
+        if block.rotate_position != rotate_position:
+            board.set_direction(None)
+            board.rotate_curr_block()
+            return
+        left_col = min(box.col for box in block.boxes)
+        if left_col < col:
+            board.set_direction('RIGHT')
+        elif left_col > col:
+            board.set_direction('LEFT')
         else:
-            return self.boxes[2]
+            board.set_direction(None)
+            board.drop_curr_block()
+
+    def play_headless(self, max_pieces):
+        board = self.board
+        pieces = 0
+        while not board.game_over and pieces < max_pieces:
+            block = board.get_curr_block()
+            target = self.plan(block)
+            if target is not None:
+                rotate_position, col = target
+                self.rotate_headless(block, rotate_position)
+                self.shift_headless(block, col)
+            board.drop_curr_block()
+            board.update(0)
+            pieces += 1
+        return pieces
+
+    def rotate_headless(self, block, rotate_position):
+        attempts = block.max_rotate_positions
+        while block.rotate_position != rotate_position and attempts:
+            self.board.rotate_curr_block()
+            self.board.update(0)
+            attempts -= 1
+
+    def shift_headless(self, block, col):
+        left_col = min(box.col for box in block.boxes)
+        while left_col != col:
+            step = 1 if left_col < col else -1
+            if not self.board.shift_curr_block(step):
+                break
+            left_col += step
 
-    def get_left_box(self):
-        if self.is_left_position():
-            return self.boxes[3]
-        else:
-            return self.boxes[0]
 
-    def get_right_box(self):
-        if self.is_right_position():
-            return self.boxes[3]
-        else:
-            return self.boxes[2]
+ReplayKeyframe = collections.namedtuple(
+    'ReplayKeyframe', ['tick', 'piece', 'input_index', 'paused', 'snapshot'])
 
-    def get_bottom_boxes(self):
-        if self.is_bottom_position():
-            return [self.boxes[3]]
-        elif self.is_top_position():
-            return self.boxes[0:3]
+REPLAY_HEADER = struct.Struct('<4sHBxQHHH')
+REPLAY_KEYFRAME_HEADER = struct.Struct('<IIIBBII')
+REPLAY_INDEX_ENTRY = struct.Struct('<IIIQI')
+REPLAY_FOOTER = struct.Struct('<QI4s')
+REPLAY_DT_RUN = struct.Struct('<dI')
+
+
+class ReplayRecorder:
+
+    def __init__(self, board, seed, level, get_scores,
+                 keyframe_interval=REPLAY_KEYFRAME_INTERVAL):
+        self.board = board
+        self.seed = seed
+        self.level = level
+        self.get_scores = get_scores
+        self.keyframe_interval = keyframe_interval
+        self.ticks = 0
+        self.pieces = 0
+        self.dt_runs = []
+        self.input_ticks = array.array('I')
+        self.input_codes = bytearray()
+        self.keyframes = []
+        self.listeners = (
+            ('TICK', self.on_tick),
+            ('INPUT', self.on_input),
+            ('LOCK', self.on_lock),
+            ('RESTORE', self.on_restore),
+        )
+        for event, listener in self.listeners:
+            board.add_listener(event, listener)
+        self.add_keyframe(board.take_compact_snapshot(*get_scores()))
+
+    def stop(self):
+        for event, listener in self.listeners:
+            self.board.event_emitter.remove_listener(event, listener)
+
+    def on_tick(self, delta_time):
+        if self.dt_runs and self.dt_runs[-1][0] == delta_time:
+            self.dt_runs[-1][1] += 1
         else:
-            return [self.boxes[2]]
-
-    def rotate(self):
-        self.rotate_position += 1
-        if self.rotate_position == self.max_rotate_positions:
-            self.rotate_position = 0
-
-        if self.rotate_position == 0:
-            self.use_right_position()
-        elif self.rotate_position == 1:
-            self.use_bottom_position()
-        elif self.rotate_position == 2:
-            self.use_left_position()
-        elif self.rotate_position == 3:
-            self.use_top_position()
-
-    def make_rotated(self):
-        block = TBlock(self.copy_boxes(), self.factory, prepared_boxes=True)
-        block.rotate_position = self.rotate_position
-        block.rotate()
-        return block
+            self.dt_runs.append([delta_time, 1])
+        self.ticks += 1
+
+    def on_input(self, action):
+        self.input_ticks.append(self.ticks)
+        self.input_codes.append(REPLAY_INPUT_CODES[action])
+
+    def on_lock(self):
+        self.pieces += 1
+        if self.pieces % self.keyframe_interval == 0:
+            self.add_keyframe(
+                self.board.take_compact_snapshot(*self.get_scores()))
+
+    def on_restore(self, snapshot):
+        self.on_input('REWIND')
+        self.add_keyframe(snapshot)
+
+    def add_keyframe(self, snapshot):
+        self.keyframes.append(ReplayKeyframe(
+            self.ticks, self.pieces, len(self.input_codes),
+            self.board.paused, snapshot))
+
+    def to_bytes(self):
+        chunks = [REPLAY_HEADER.pack(
+            REPLAY_MAGIC, REPLAY_VERSION, self.level, self.seed,
+            self.keyframe_interval, self.board.block_end_row,
+            self.board.block_end_col)]
+        chunks.append(struct.pack('<I', len(self.dt_runs)))
+        for delta_time, count in self.dt_runs:
+            chunks.append(REPLAY_DT_RUN.pack(delta_time, count))
+        chunks.append(struct.pack('<I', len(self.input_codes)))
+        chunks.append(self.input_ticks.tobytes())
+        chunks.append(bytes(self.input_codes))
+
+        offset = sum(len(chunk) for chunk in chunks)
+        index = []
+        for keyframe in self.keyframes:
+            payload = pack_keyframe(keyframe)
+            index.append(REPLAY_INDEX_ENTRY.pack(
+                keyframe.tick, keyframe.piece, keyframe.input_index,
+                offset, len(payload)))
+            chunks.append(payload)
+            offset += len(payload)
+        chunks.extend(index)
+        chunks.append(REPLAY_FOOTER.pack(
+            offset, len(index), REPLAY_INDEX_MAGIC))
+        return b''.join(chunks)
+
+
+def pack_keyframe(keyframe):
+    snapshot = keyframe.snapshot
+    next_kind = ord(snapshot.next_kind) if snapshot.next_kind else 0
+    payload = b''.join([
+        REPLAY_KEYFRAME_HEADER.pack(
+            keyframe.tick, keyframe.piece, keyframe.input_index,
+            keyframe.paused, next_kind, snapshot.scores, snapshot.lines),
+        struct.pack('<I', len(snapshot.cells)), snapshot.cells,
+        struct.pack('<H', len(snapshot.rng_state)), snapshot.rng_state,
+    ])
+    return zlib.compress(payload)
+
+
+def unpack_keyframe(data):
+    payload = zlib.decompress(data)
+    (tick, piece, input_index, paused, next_kind, scores,
+     lines) = REPLAY_KEYFRAME_HEADER.unpack_from(payload)
+    offset = REPLAY_KEYFRAME_HEADER.size
+    cells_size, = struct.unpack_from('<I', payload, offset)
+    offset += 4
+    cells = payload[offset:offset + cells_size]
+    offset += cells_size
+    rng_size, = struct.unpack_from('<H', payload, offset)
+    offset += 2
+    rng_state = payload[offset:offset + rng_size]
+    snapshot = CompactSnapshot(
+        cells, chr(next_kind) if next_kind else None, rng_state, scores,
+        lines)
+    return ReplayKeyframe(tick, piece, input_index, bool(paused), snapshot)
+
+
+class ReplayArchive:
+
+    def __init__(self, data):
+        self.data = data
+        (magic, version, self.level, self.seed, self.keyframe_interval,
+         self.rows, self.cols) = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError('not a replay file')
+        offset = REPLAY_HEADER.size
+
+        run_count, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        self.dt_values = []
+        self.dt_starts = []
+        self.tick_count = 0
+        for _ in range(run_count):
+            delta_time, count = REPLAY_DT_RUN.unpack_from(data, offset)
+            offset += REPLAY_DT_RUN.size
+            self.dt_values.append(delta_time)
+            self.dt_starts.append(self.tick_count)
+            self.tick_count += count
+
+        input_count, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        self.input_ticks = array.array('I')
+        self.input_ticks.frombytes(data[offset:offset + input_count * 4])
+        offset += input_count * 4
+        self.input_codes = data[offset:offset + input_count]
+
+        index_offset, keyframe_count, magic = REPLAY_FOOTER.unpack_from(
+            data, len(data) - REPLAY_FOOTER.size)
+        if magic != REPLAY_INDEX_MAGIC:
+            raise ValueError('replay index missing')
+        self.index = [
+            REPLAY_INDEX_ENTRY.unpack_from(
+                data, index_offset + i * REPLAY_INDEX_ENTRY.size)
+            for i in range(keyframe_count)]
+        self.keyframe_ticks = [entry[0] for entry in self.index]
+        # Klatka cofnięcia jest zapisywana zaraz po wejściu REWIND, więc
+        # jest pierwszą klatką z danym numerem wejścia; późniejsze klatki
+        # po położeniu klocka mogą mieć ten sam numer.
+        self.keyframes_by_input = {}
+        for number, entry in enumerate(self.index):
+            self.keyframes_by_input.setdefault(entry[2], number)
 
-    def use_top_position(self):
-        """
-        Example:
-               [3]
-            [0][1][2]
-        """
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row
-        self.boxes[0].col = col - 1
-        self.boxes[2].row = row
-        self.boxes[2].col = col + 1
-        self.boxes[3].row = row - 1
-        self.boxes[3].col = col
-
-    def use_bottom_position(self):
-        """
-        Example:
-            [0][1][2]
-               [3]
-        """
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row
-        self.boxes[0].col = col - 1
-        self.boxes[2].row = row
-        self.boxes[2].col = col + 1
-        self.boxes[3].row = row + 1
-        self.boxes[3].col = col
-
-    def use_left_position(self):
-        """
-        Example:
-             [0]
-          [3][1]
-             [2]
-        """
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row - 1
-        self.boxes[0].col = col
-        self.boxes[2].row = row + 1
-        self.boxes[2].col = col
-        self.boxes[3].row = row
-        self.boxes[3].col = col - 1
-
-    def use_right_position(self):
-        """
-        Example:
-            [0]
-            [1][3]
-            [2]
-        """
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row - 1
-        self.boxes[0].col = col
-        self.boxes[2].row = row + 1
-        self.boxes[2].col = col
-        self.boxes[3].row = row
-        self.boxes[3].col = col + 1
-
-
-class ZBlock(Block):
-    required_boxes = 4
-    max_rotate_positions = 2
-    kind = 'Z'
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as document:
+            return cls(document.read())
 
-    def prepare_boxes(self, boxes):
-        row = boxes[0].row
-        col = boxes[0].col
-        boxes[1].row = row + 1
-        boxes[1].col = col
-        boxes[2].row = row + 1
-        boxes[2].col = col - 1
-        boxes[3].row = row + 2
-        boxes[3].col = col - 1
+    def get_keyframe(self, number):
+        _, _, _, offset, size = self.index[number]
+        return unpack_keyframe(self.data[offset:offset + size])
 
-    def is_vertical(self):
-        return self.rotate_position == 0
+    def find_keyframe(self, tick):
+        number = bisect.bisect_right(self.keyframe_ticks, tick) - 1
+        # Klatka cofnięcia opisuje stan po części wejść swojego taktu,
+        # więc nie może być początkiem tego taktu.
+        while number > 0 and self.is_inside_tick(number, tick):
+            number -= 1
+        return max(number, 0)
 
-    def get_top_box(self):
-        return self.boxes[0]
+    def is_inside_tick(self, number, tick):
+        keyframe_tick, _, input_index, _, _ = self.index[number]
+        return (keyframe_tick == tick and input_index >
+                bisect.bisect_left(self.input_ticks, tick))
 
-    def get_bottom_box(self):
-        return self.boxes[3]
+    def get_delta_time(self, tick):
+        run = bisect.bisect_right(self.dt_starts, tick) - 1
+        return self.dt_values[run]
 
-    def get_left_box(self):
-        if self.is_vertical():
-            return self.boxes[2]
-        else:
-            return self.boxes[0]
 
-    def get_right_box(self):
-        if self.is_vertical():
-            return self.boxes[0]
-        else:
-            return self.boxes[3]
+class ReplayPlayer:
 
-    def get_bottom_boxes(self):
-        if self.is_vertical():
-            return [self.boxes[3]]
-        else:
-            return [self.boxes[2], self.boxes[3]]
-
-    def rotate(self):
-        self.rotate_position += 1
-        if self.rotate_position == self.max_rotate_positions:
-            self.rotate_position = 0
-
-        if self.rotate_position == 0:
-            self.use_position_vertical()
-        elif self.rotate_position == 1:
-            self.use_position_horizontal()
-
-    def make_rotated(self):
-        block = ZBlock(self.copy_boxes(), self.factory, prepared_boxes=True)
-        block.rotate_position = self.rotate_position
-        block.rotate()
-        return block
+    def __init__(self, archive, pieces_file=None):
+        self.archive = archive
+        self.play_activity = PlayActivity()
+        self.play_activity.recording = False
+        self.play_activity.level = archive.level
+        self.play_activity.rows = archive.rows
+        self.play_activity.cols = archive.cols
+        self.play_activity.pieces_file = pieces_file
+        self.play_activity.prepare()
+        self.board = self.play_activity.board
+        self.tick = 0
+        self.input_index = 0
+        self.budget = 0.0
+        self.seek_keyframe(0)
+
+    def seek_keyframe(self, number):
+        self.restore(self.archive.get_keyframe(number))
+        self.budget = 0.0
+
+    def seek(self, tick):
+        self.seek_keyframe(self.archive.find_keyframe(tick))
+        while self.tick < tick and self.step():
+            pass
+
+    def restore(self, keyframe):
+        play_activity = self.play_activity
+        self.board.restore_compact_snapshot(keyframe.snapshot)
+        self.board.paused = keyframe.paused
+        play_activity.scores = keyframe.snapshot.scores
+        play_activity.lines = keyframe.snapshot.lines
+        play_activity.clear_game_over()
+        self.tick = keyframe.tick
+        self.input_index = keyframe.input_index
+
+    def is_finished(self):
+        return self.tick >= self.archive.tick_count
+
+    def step(self):
+        if self.is_finished():
+            return False
+        archive = self.archive
+        while (self.input_index < len(archive.input_ticks) and
+               archive.input_ticks[self.input_index] == self.tick):
+            code = archive.input_codes[self.input_index]
+            self.input_index += 1
+            if code == REPLAY_INPUT_CODES['REWIND']:
+                number = archive.keyframes_by_input[self.input_index]
+                self.restore(archive.get_keyframe(number))
+            else:
+                self.apply_input(code)
+        self.play_activity.update(archive.get_delta_time(self.tick))
+        self.tick += 1
+        return True
+
+    def apply_input(self, code):
+        board = self.board
+        if (code != REPLAY_INPUT_CODES['PAUSE'] and
+                not board.game_over and not board.paused):
+            # Klocek mógł zostać pobrany poza taktem, np. przez AI.
+            board.get_curr_block()
+        apply_input_code(board, code)
+
+    def advance(self, replay_time):
+        self.budget += replay_time
+        while not self.is_finished():
+            delta_time = self.archive.get_delta_time(self.tick)
+            if delta_time > self.budget:
+                break
+            self.budget -= delta_time
+            self.step()
+
+
+def apply_input_code(board, code):
+    if code == REPLAY_INPUT_CODES['LEFT']:
+        board.set_direction('LEFT')
+    elif code == REPLAY_INPUT_CODES['RIGHT']:
+        board.set_direction('RIGHT')
+    elif code == REPLAY_INPUT_CODES['DOWN']:
+        board.set_direction('DOWN')
+    elif code == REPLAY_INPUT_CODES['STOP']:
+        board.set_direction(None)
+    elif code == REPLAY_INPUT_CODES['ROTATE']:
+        board.rotate_curr_block()
+    elif code == REPLAY_INPUT_CODES['DROP']:
+        board.drop_curr_block()
+    elif code == REPLAY_INPUT_CODES['SHIFT_LEFT']:
+        board.shift_curr_block(-1)
+    elif code == REPLAY_INPUT_CODES['SHIFT_RIGHT']:
+        board.shift_curr_block(1)
+    elif code == REPLAY_INPUT_CODES['PAUSE']:
+        board.toggle_pause()
+
+
+class ReplayViewer(Activity):
+
+    def __init__(self, archive, speed=1.0, pieces_file=None):
+        super().__init__()
+        self.archive = archive
+        self.speed = speed
+        self.pieces_file = pieces_file
+        self.paused = False
+        self.player = None
+        self.info_label = None
+        self.event_emitter = EventEmitter()
 
-    def use_position_vertical(self):
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row - 1
-        self.boxes[0].col = col
-        self.boxes[2].row = row
-        self.boxes[2].col = col - 1
-        self.boxes[3].row = row + 1
-        self.boxes[3].col = col - 1
-
-    def use_position_horizontal(self):
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row
-        self.boxes[0].col = col - 1
-        self.boxes[2].row = row + 1
-        self.boxes[2].col = col
-        self.boxes[3].row = row + 1
-        self.boxes[3].col = col + 1
-
-
-class SBlock(Block):
-    required_boxes = 4
-    max_rotate_positions = 2
-    kind = 'S'
+    def prepare(self):
+        self.player = ReplayPlayer(self.archive, self.pieces_file)
+        self.info_label = Label(10, 515, COLOR_BLACK, '')
 
-    def prepare_boxes(self, boxes):
-        row = boxes[0].row
-        col = boxes[0].col
-        boxes[1].row = row + 1
-        boxes[1].col = col
-        boxes[2].row = row + 1
-        boxes[2].col = col + 1
-        boxes[3].row = row + 2
-        boxes[3].col = col + 1
+    def add_exit_listener(self, listener):
+        self.event_emitter.add_listener('EXIT', listener)
+
+    def on_keydown(self, key):
+        if key == pygame.K_ESCAPE:
+            self.event_emitter.emit('EXIT')
+        elif key == pygame.K_UP:
+            self.speed = min(self.speed * 10, 10000)
+        elif key == pygame.K_DOWN:
+            self.speed = max(self.speed / 10, 0.1)
+        elif key == pygame.K_RIGHT:
+            self.seek_keyframe(1)
+        elif key == pygame.K_LEFT:
+            self.seek_keyframe(-1)
+        elif key == pygame.K_p:
+            self.paused = not self.paused
+
+    def seek_keyframe(self, step):
+        archive = self.archive
+        number = archive.find_keyframe(self.player.tick)
+        if step < 0 and archive.keyframe_ticks[number] == self.player.tick:
+            number -= 1
+        elif step > 0:
+            number += 1
+        number = min(max(number, 0), len(archive.index) - 1)
+        self.player.seek_keyframe(number)
 
-    def is_vertical(self):
-        return self.rotate_position == 0
+    def update(self, delta_time):
+        if not self.paused:
+            self.player.advance(delta_time * self.speed)
+        self.info_label.label = 'POWTÓRKA x{:g}  {} / {}'.format(
+            self.speed, self.player.tick, self.archive.tick_count)
 
-    def get_top_box(self):
-        return self.boxes[0]
+    def render(self, painter):
+        self.player.play_activity.render(painter)
+        self.info_label.render(painter)
 
-    def get_bottom_box(self):
-        return self.boxes[3]
+    def enable_animations(self):
+        self.player.play_activity.enable_animations()
 
-    def get_left_box(self):
-        if self.is_vertical():
-            return self.boxes[1]
-        else:
-            return self.boxes[3]
 
-    def get_right_box(self):
-        if self.is_vertical():
-            return self.boxes[3]
-        else:
-            return self.boxes[0]
+PieceRecord = collections.namedtuple(
+    'PieceRecord',
+    ['game_id', 'score', 'frame', 'kind', 'rotation', 'col', 'lines'])
 
-    def get_bottom_boxes(self):
-        if self.is_vertical():
-            return [self.boxes[3]]
+PIECE_STORE_HEADER = struct.Struct('<4sHH8x')
+PIECE_RECORD = struct.Struct('<QIIBBhB3x')
+PIECE_RECORD_DTYPE = [
+    ('game_id', '<u8'), ('score', '<u4'), ('frame', '<u4'),
+    ('kind', 'u1'), ('rotation', 'u1'), ('col', '<i2'), ('lines', 'u1'),
+    ('padding', 'V3'),
+]
+
+
+class PieceRecorder:
+
+    def __init__(self, board, game_id, get_scores):
+        self.board = board
+        self.game_id = game_id
+        self.get_scores = get_scores
+        self.frame = 0
+        self.pending = None
+        self.records = bytearray()
+        self.game_over = False
+        self.listeners = (
+            ('TICK', self.on_tick),
+            ('SOUND', self.on_sound),
+            (EVENT_FULL_LINES, self.on_full_lines),
+            ('GAME_OVER', self.on_game_over),
+            ('LOCK', self.on_lock),
+        )
+        for event, listener in self.listeners:
+            board.add_listener(event, listener)
+
+    def stop(self):
+        for event, listener in self.listeners:
+            self.board.event_emitter.remove_listener(event, listener)
+
+    def on_tick(self, delta_time):
+        self.frame += 1
+
+    def on_sound(self, sound):
+        if sound != 'stop':
+            return
+        block = self.board.locked_block
+        self.pending = [
+            ord(block.kind), block.rotate_position,
+            min(box.col for box in block.boxes), 0]
+
+    def on_full_lines(self, count):
+        if self.pending is not None:
+            self.pending[3] = count
+
+    def on_game_over(self):
+        self.game_over = True
+
+    def on_lock(self):
+        if self.pending is None:
+            return
+        kind, rotation, col, lines = self.pending
+        self.pending = None
+        self.records += PIECE_RECORD.pack(
+            self.game_id, self.get_scores()[0], self.frame,
+            kind, rotation, col, lines)
+
+    def record_count(self):
+        return len(self.records) // PIECE_RECORD.size
+
+    def take_records(self):
+        self.game_over = False
+        records = bytes(self.records)
+        self.records.clear()
+        return records
+
+
+class PieceStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, records):
+        with self.lock, open(self.path, 'ab') as document:
+            if document.tell() == 0:
+                document.write(PIECE_STORE_HEADER.pack(
+                    PIECE_STORE_MAGIC, PIECE_STORE_VERSION,
+                    PIECE_RECORD.size))
+            document.write(records)
+            document.flush()
+            os.fsync(document.fileno())
+
+    def open_view(self):
+        with open(self.path, 'rb') as document:
+            size = os.fstat(document.fileno()).st_size
+            if size < PIECE_STORE_HEADER.size:
+                return None
+            view = mmap.mmap(
+                document.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = PIECE_STORE_HEADER.unpack_from(view)
+        if (magic != PIECE_STORE_MAGIC or
+                version != PIECE_STORE_VERSION or
+                record_size != PIECE_RECORD.size):
+            view.close()
+            raise ValueError('not a piece store')
+        return view
+
+    def get_count(self, view):
+        # Niedokończony ostatni rekord (np. po awarii) jest pomijany.
+        return (len(view) - PIECE_STORE_HEADER.size) // PIECE_RECORD.size
+
+    def load_array(self):
+        view = self.open_view()
+        if view is None:
+            return numpy.zeros(0, dtype=PIECE_RECORD_DTYPE)
+        count = self.get_count(view)
+        view.close()
+        return numpy.memmap(
+            self.path, dtype=PIECE_RECORD_DTYPE, mode='r',
+            offset=PIECE_STORE_HEADER.size, shape=(count,))
+
+    def iter_chunks(self, chunk_size=PIECE_STORE_CHUNK):
+        if numpy is not None:
+            records = self.load_array()
+            for start in range(0, len(records), chunk_size):
+                yield records[start:start + chunk_size]
+            return
+        view = self.open_view()
+        if view is None:
+            return
+        try:
+            count = self.get_count(view)
+            for start in range(0, count, chunk_size):
+                stop = min(start + chunk_size, count)
+                chunk = memoryview(view)[
+                    PIECE_STORE_HEADER.size + start * PIECE_RECORD.size:
+                    PIECE_STORE_HEADER.size + stop * PIECE_RECORD.size]
+                yield [PieceRecord(*record)
+                       for record in PIECE_RECORD.iter_unpack(chunk)]
+                chunk.release()
+        finally:
+            view.close()
+
+    def iter_records(self, chunk_size=PIECE_STORE_CHUNK):
+        for chunk in self.iter_chunks(chunk_size):
+            if numpy is None:
+                yield from chunk
+                continue
+            for record in chunk.tolist():
+                yield PieceRecord(*record[:7])
+
+    def summarize(self, chunk_size=PIECE_STORE_CHUNK):
+        stats = {'pieces': 0, 'lines': 0, 'kinds': {}, 'line_counts': {}}
+        games = set()
+        for chunk in self.iter_chunks(chunk_size):
+            if numpy is not None:
+                stats['pieces'] += len(chunk)
+                stats['lines'] += int(chunk['lines'].sum())
+                games.update(numpy.unique(chunk['game_id']).tolist())
+                add_counts(stats['kinds'], chunk['kind'])
+                add_counts(stats['line_counts'], chunk['lines'])
+                continue
+            for record in chunk:
+                stats['pieces'] += 1
+                stats['lines'] += record.lines
+                games.add(record.game_id)
+                add_count(stats['kinds'], record.kind, 1)
+                add_count(stats['line_counts'], record.lines, 1)
+        stats['games'] = len(games)
+        stats['kinds'] = dict(
+            (chr(kind), count) for kind, count in stats['kinds'].items())
+        return stats
+
+
+def add_counts(counts, values):
+    keys, key_counts = numpy.unique(values, return_counts=True)
+    for key, count in zip(keys.tolist(), key_counts.tolist()):
+        add_count(counts, key, count)
+
+
+def add_count(counts, key, count):
+    counts[key] = counts.get(key, 0) + count
+
+
+def print_piece_stats(path):
+    stats = PieceStore(path).summarize()
+    print('GRY: {}, KLOCKI: {}, LINIE: {}'.format(
+        stats['games'], stats['pieces'], stats['lines']))
+    for kind, count in sorted(stats['kinds'].items()):
+        print('KLOCEK {}: {}'.format(kind, count))
+    for lines, count in sorted(stats['line_counts'].items()):
+        print('LINIE NARAZ {}: {}'.format(lines, count))
+
+
+class TetrisEnv:
+
+    def __init__(self, level=1, seed=None, step_time=ENV_STEP_TIME,
+                 rows=None, cols=None, pieces_file=None):
+        self.level = level
+        self.seed = seed
+        self.step_time = step_time
+        self.rows = rows
+        self.cols = cols
+        self.pieces_file = pieces_file
+        self.board = None
+        self.lines = 0
+        self.reset(seed)
+
+    def get_observation_shape(self):
+        return self.board.block_end_row, self.board.block_end_col
+
+    def reset(self, seed=None):
+        if seed is None:
+            seed = self.seed
+        self.board = create_board(
+            lambda: self.level, seed, pieces_file=self.pieces_file,
+            rows=self.rows, cols=self.cols)
+        self.board.add_listener(EVENT_FULL_LINES, self.on_full_lines)
+        self.board.get_curr_block()
+        self.lines = 0
+        return self.observation()
+
+    def on_full_lines(self, count):
+        self.lines += count
+
+    def step(self, action):
+        board = self.board
+        name = ENV_ACTIONS[action]
+        if name == 'LEFT':
+            board.shift_curr_block(-1)
+        elif name == 'RIGHT':
+            board.shift_curr_block(1)
+        elif name == 'ROTATE':
+            board.rotate_curr_block()
+        elif name == 'DROP':
+            board.drop_curr_block()
+        lines = self.lines
+        board.update(self.step_time)
+        if not board.game_over:
+            board.get_curr_block()
+        reward = (self.lines - lines) * self.level
+        info = {'lines': self.lines, 'next': board.next_block.kind}
+        return self.observation(), reward, board.game_over, info
+
+    def observation(self, out=None):
+        rows, cols = self.get_observation_shape()
+        if out is None:
+            out = bytearray(rows * cols)
+        empty_row = bytes([ENV_CELL_EMPTY]) * cols
+        static_boxes = self.board.static_boxes
+        for row in range(rows):
+            offset = row * cols
+            boxes = static_boxes.rows.get(row)
+            if boxes is None:
+                out[offset:offset + cols] = empty_row
+                continue
+            for col, box in enumerate(boxes):
+                out[offset + col] = (
+                    ENV_CELL_EMPTY if box is None else ENV_CELL_STATIC)
+        block = self.board.curr_block
+        if block is not None:
+            for box in block.boxes:
+                if 0 <= box.row < rows and 0 <= box.col < cols:
+                    out[box.row * cols + box.col] = ENV_CELL_BLOCK
+        return out
+
+
+class VectorEnv:
+
+    def __init__(self, count, level=1, seed=None, rows=None, cols=None,
+                 pieces_file=None):
+        # Procesy uruchamiane przez spawn nie widzą zmian w zmiennych
+        # globalnych, więc rozmiar planszy i klocki dostają jawnie.
+        self.count = count
+        self.shape = TetrisEnv(
+            level, seed, rows=rows, cols=cols,
+            pieces_file=pieces_file).get_observation_shape()
+        _, dones_offset = get_env_layout(count, self.shape)
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=dones_offset + count)
+        self.connections = []
+        self.workers = []
+        for index in range(count):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker_seed = None if seed is None else seed + index
+            worker = multiprocessing.Process(
+                target=run_env_worker,
+                args=(worker_connection, self.memory.name, index, count,
+                      level, worker_seed, rows, cols, pieces_file),
+                daemon=True)
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+        self.observations, self.rewards, self.dones = get_env_views(
+            self.memory.buf, count, self.shape)
+
+    def get_observation(self, index):
+        size = self.shape[0] * self.shape[1]
+        if numpy is not None:
+            return self.observations[index]
+        return self.observations[index * size:(index + 1) * size]
+
+    def reset(self):
+        for connection in self.connections:
+            connection.send(('reset', None))
+        self.wait()
+        return self.observations
+
+    def step(self, actions):
+        for connection, action in zip(self.connections, actions):
+            connection.send(('step', action))
+        self.wait()
+        return self.observations, self.rewards, self.dones
+
+    def wait(self):
+        for connection in self.connections:
+            connection.recv()
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(('close', None))
+        for worker in self.workers:
+            worker.join()
+        for connection in self.connections:
+            connection.close()
+        if numpy is None:
+            for view in (self.observations, self.rewards, self.dones):
+                view.release()
+        self.observations = self.rewards = self.dones = None
+        self.memory.unlink()
+        self.memory.close()
+
+
+def get_env_layout(count, shape):
+    rows, cols = shape
+    rewards_offset = (count * rows * cols + 7) // 8 * 8
+    return rewards_offset, rewards_offset + count * 8
+
+
+def get_env_views(buffer, count, shape):
+    rows, cols = shape
+    rewards_offset, dones_offset = get_env_layout(count, shape)
+    if numpy is not None:
+        return (
+            numpy.ndarray(
+                (count, rows, cols), numpy.uint8, buffer, 0),
+            numpy.ndarray((count,), numpy.float64, buffer, rewards_offset),
+            numpy.ndarray((count,), numpy.bool_, buffer, dones_offset))
+    return (
+        buffer[:count * rows * cols],
+        buffer[rewards_offset:dones_offset].cast('d'),
+        buffer[dones_offset:dones_offset + count])
+
+
+def run_env_worker(connection, memory_name, index, count, level, seed,
+                   rows=None, cols=None, pieces_file=None):
+    memory = shared_memory.SharedMemory(name=memory_name)
+    env = TetrisEnv(
+        level, seed, rows=rows, cols=cols, pieces_file=pieces_file)
+    shape = env.get_observation_shape()
+    size = shape[0] * shape[1]
+    rewards_offset, dones_offset = get_env_layout(count, shape)
+    out = memory.buf[index * size:(index + 1) * size]
+    rewards = memory.buf[rewards_offset:dones_offset].cast('d')
+    dones = memory.buf[dones_offset:dones_offset + count]
+    while True:
+        command, action = connection.recv()
+        if command == 'close':
+            break
+        if command == 'reset':
+            env.reset()
+            env.observation(out)
+            rewards[index] = 0.0
+            dones[index] = 0
         else:
-            return [self.boxes[2], self.boxes[3]]
-
-    def rotate(self):
-        self.rotate_position += 1
-        if self.rotate_position == self.max_rotate_positions:
-            self.rotate_position = 0
-
-        if self.rotate_position == 0:
-            self.use_position_vertical()
-        elif self.rotate_position == 1:
-            self.use_position_horizontal()
-
-    def make_rotated(self):
-        block = SBlock(self.copy_boxes(), self.factory, prepared_boxes=True)
-        block.rotate_position = self.rotate_position
-        block.rotate()
-        return block
+            _, reward, done, _ = env.step(action)
+            if done:
+                env.reset()
+            env.observation(out)
+            rewards[index] = reward
+            dones[index] = done
+        connection.send(True)
+    del out, rewards, dones
+    memory.close()
+
+
+FeedState = collections.namedtuple(
+    'FeedState',
+    ['frame', 'scores', 'lines', 'level', 'kind', 'rotation', 'game_over',
+     'paused', 'boxes', 'cells'])
+
+FEED_HEADER = struct.Struct('<4sHHH6xQ')
+FEED_SEQUENCE = struct.Struct('<Q')
+FEED_SEQUENCE_OFFSET = 16
+FEED_STATE = struct.Struct('<QIIHBBBBBx')
+FEED_BOXES = struct.Struct('<{}h'.format(FEED_MAX_BOXES * 2))
+
+
+class BoardFeed:
+
+    def __init__(self, name, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.frame = 0
+        self.version = None
+        self.written_rows = set()
+        self.empty_row = bytes(cols)
+        size = FEED_HEADER.size + FEED_STATE.size + FEED_BOXES.size
+        self.cells_offset = size
+        try:
+            self.memory = shared_memory.SharedMemory(
+                name, create=True, size=size + rows * cols)
+        except FileExistsError:
+            # Segment pozostawiony przez grę, która się nie zamknęła.
+            shared_memory.SharedMemory(name).unlink()
+            self.memory = shared_memory.SharedMemory(
+                name, create=True, size=size + rows * cols)
+        self.sequence = 0
+        FEED_HEADER.pack_into(
+            self.memory.buf, 0, FEED_MAGIC, FEED_VERSION, rows, cols, 0)
+
+    def publish(self, board, scores, lines, level):
+        buf = self.memory.buf
+        self.frame += 1
+        block = board.curr_block
+        boxes = [0] * (FEED_MAX_BOXES * 2)
+        kind = rotation = box_count = 0
+        if block is not None:
+            kind = ord(block.kind)
+            rotation = block.rotate_position
+            for box in block.boxes[:FEED_MAX_BOXES]:
+                boxes[box_count * 2] = box.row
+                boxes[box_count * 2 + 1] = box.col
+                box_count += 1
+
+        self.sequence += 1
+        FEED_SEQUENCE.pack_into(buf, FEED_SEQUENCE_OFFSET, self.sequence)
+        FEED_STATE.pack_into(
+            buf, FEED_HEADER.size, self.frame, scores, lines, level, kind,
+            rotation, board.game_over, board.paused, box_count)
+        FEED_BOXES.pack_into(
+            buf, FEED_HEADER.size + FEED_STATE.size, *boxes)
+        static_boxes = board.static_boxes
+        if static_boxes.version != self.version:
+            self.version = static_boxes.version
+            cells = static_boxes.pack_cells(board.get_color_index)
+            written_rows = set()
+            for row, colors in iter_packed_rows(cells, self.cols):
+                offset = self.cells_offset + row * self.cols
+                buf[offset:offset + self.cols] = colors
+                written_rows.add(row)
+            for row in self.written_rows - written_rows:
+                offset = self.cells_offset + row * self.cols
+                buf[offset:offset + self.cols] = self.empty_row
+            self.written_rows = written_rows
+        self.sequence += 1
+        FEED_SEQUENCE.pack_into(buf, FEED_SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+class BoardFeedReader:
+
+    def __init__(self, name):
+        self.memory = shared_memory.SharedMemory(name)
+        # Czytelnik nie jest właścicielem segmentu i nie może go usuwać.
+        resource_tracker.unregister(self.memory._name, 'shared_memory')
+        magic, version, self.rows, self.cols, _ = FEED_HEADER.unpack_from(
+            self.memory.buf)
+        if magic != FEED_MAGIC or version != FEED_VERSION:
+            self.memory.close()
+            raise ValueError('not a board feed')
+        self.cells_offset = (
+            FEED_HEADER.size + FEED_STATE.size + FEED_BOXES.size)
+
+    def read(self, retries=FEED_READ_RETRIES):
+        buf = self.memory.buf
+        for _ in range(retries):
+            sequence, = FEED_SEQUENCE.unpack_from(buf, FEED_SEQUENCE_OFFSET)
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            state = FEED_STATE.unpack_from(buf, FEED_HEADER.size)
+            boxes = FEED_BOXES.unpack_from(
+                buf, FEED_HEADER.size + FEED_STATE.size)
+            cells = bytes(buf[
+                self.cells_offset:
+                self.cells_offset + self.rows * self.cols])
+            if FEED_SEQUENCE.unpack_from(
+                    buf, FEED_SEQUENCE_OFFSET)[0] != sequence:
+                continue
+            (frame, scores, lines, level, kind, rotation, game_over, paused,
+             box_count) = state
+            return FeedState(
+                frame, scores, lines, level, chr(kind) if kind else None,
+                rotation, bool(game_over), bool(paused),
+                list(zip(boxes[0:box_count * 2:2], boxes[1:box_count * 2:2])),
+                cells)
+        return None
+
+    def close(self):
+        self.memory.close()
+
+
+def run_spectator(name, interval=0.2):
+    reader = BoardFeedReader(name)
+    last_frame = None
+    try:
+        while True:
+            state = reader.read()
+            if state is not None and state.frame != last_frame:
+                last_frame = state.frame
+                print(format_feed_state(state, reader.rows, reader.cols))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
 
-    def use_position_vertical(self):
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row - 1
-        self.boxes[0].col = col
-        self.boxes[2].row = row
-        self.boxes[2].col = col + 1
-        self.boxes[3].row = row + 1
-        self.boxes[3].col = col + 1
-
-    def use_position_horizontal(self):
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row
-        self.boxes[0].col = col + 1
-        self.boxes[2].row = row + 1
-        self.boxes[2].col = col
-        self.boxes[3].row = row + 1
-        self.boxes[3].col = col - 1
-
-
-class LBlock(Block):
-    required_boxes = 4
-    max_rotate_positions = 4
-    kind = 'L'
 
-    def prepare_boxes(self, boxes):
-        boxes[1].row = boxes[0].row + 1
-        boxes[1].col = boxes[0].col
-        boxes[2].row = boxes[0].row + 2
-        boxes[2].col = boxes[0].col
-        boxes[3].row = boxes[0].row + 2
-        boxes[3].col = boxes[0].col + 1
+def format_feed_state(state, rows, cols):
+    grid = [['#' if state.cells[row * cols + col] else '.'
+             for col in range(cols)] for row in range(rows)]
+    for row, col in state.boxes:
+        if 0 <= row < rows and 0 <= col < cols:
+            grid[row][col] = '@'
+    lines = ['KLATKA: {}, PUNKTY: {}, LINIE: {}, POZIOM: {}{}'.format(
+        state.frame, state.scores, state.lines, state.level,
+        ', GAME OVER' if state.game_over else '')]
+    lines.extend(''.join(row) for row in grid)
+    return '\n'.join(lines)
 
-    def is_right_position(self):
-        return self.rotate_position == 0
 
-    def is_bottom_position(self):
-        return self.rotate_position == 1
+MESSAGE_HEADER = struct.Struct('<IB')
+MESSAGE_FULL_HEAD = struct.Struct('<HHB')
+MESSAGE_DELTA_HEAD = struct.Struct('<IIIBBBBB')
+MESSAGE_CELL = struct.Struct('<IB')
+MESSAGE_BOX = struct.Struct('<hh')
 
-    def is_left_position(self):
-        return self.rotate_position == 2
 
-    def is_top_position(self):
-        return self.rotate_position == 3
+def encode_message(kind, payload):
+    return MESSAGE_HEADER.pack(len(payload), kind) + payload
 
-    def get_top_box(self):
-        if self.is_top_position() or self.is_right_position():
-            return self.boxes[0]
-        elif self.is_bottom_position() or self.is_left_position():
-            return self.boxes[2]
 
-    def get_bottom_box(self):
-        return self.get_bottom_boxes()[0]
+async def read_message(reader):
+    size, kind = MESSAGE_HEADER.unpack(
+        await reader.readexactly(MESSAGE_HEADER.size))
+    return kind, await reader.readexactly(size)
 
-    def get_left_box(self):
-        if self.is_left_position() or self.is_bottom_position():
-            return self.boxes[3]
-        elif self.is_top_position() or self.is_right_position():
-            return self.boxes[0]
 
-    def get_right_box(self):
-        if self.is_left_position() or self.is_bottom_position():
-            return self.boxes[0]
-        elif self.is_top_position() or self.is_right_position():
-            return self.boxes[3]
+def encode_palette(palette):
+    return b''.join(bytes(color) for color in palette)
 
-    def get_bottom_boxes(self):
-        if self.is_bottom_position():
-            return [self.boxes[3]]
-        elif self.is_left_position():
-            return [self.boxes[0]]
-        elif self.is_right_position():
-            return [self.boxes[2], self.boxes[3]]
-        elif self.is_top_position():
-            return self.boxes[:3]
-
-    def rotate(self):
-        self.rotate_position += 1
-        if self.rotate_position == self.max_rotate_positions:
-            self.rotate_position = 0
-
-        if self.rotate_position == 0:
-            self.use_right_position()
-        elif self.rotate_position == 1:
-            self.use_bottom_position()
-        elif self.rotate_position == 2:
-            self.use_left_position()
-        elif self.rotate_position == 3:
-            self.use_top_position()
-
-    def make_rotated(self):
-        block = LBlock(self.copy_boxes(), self.factory, prepared_boxes=True)
-        block.rotate_position = self.rotate_position
-        block.rotate()
-        return block
 
-    def use_top_position(self):
-        """
-        Example:
-                [3]
-          [0][1][2]
-        """
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row
-        self.boxes[0].col = col - 1
-        self.boxes[2].row = row
-        self.boxes[2].col = col + 1
-        self.boxes[3].row = row - 1
-        self.boxes[3].col = col + 1
-
-    def use_bottom_position(self):
-        """
-        Example:
-            [2][1][0]
-            [3]
-        """
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row
-        self.boxes[0].col = col + 1
-        self.boxes[2].row = row
-        self.boxes[2].col = col - 1
-        self.boxes[3].row = row + 1
-        self.boxes[3].col = col - 1
-
-    def use_left_position(self):
-        """
-        Example:
-            [3][2]
-               [1]
-               [0]
-        """
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row + 1
-        self.boxes[0].col = col
-        self.boxes[2].row = row - 1
-        self.boxes[2].col = col
-        self.boxes[3].row = row - 1
-        self.boxes[3].col = col - 1
-
-    def use_right_position(self):
-        """
-        Example:
-           [0]
-           [1]
-           [2][3]
-        """
-        row = self.boxes[1].row
-        col = self.boxes[1].col
-        self.boxes[0].row = row - 1
-        self.boxes[0].col = col
-        self.boxes[2].row = row + 1
-        self.boxes[2].col = col
-        self.boxes[3].row = row + 1
-        self.boxes[3].col = col + 1
-
-
-class BigBlock(Block):
-    required_boxes = 4
-    kind = 'O'
+def decode_palette(data, count):
+    return [tuple(data[i * 3:i * 3 + 3]) for i in range(count)]
 
-    def prepare_boxes(self, boxes):
-        row = boxes[0].row
-        col = boxes[0].col
-        boxes[1].row = row
-        boxes[1].col = col + 1
-        boxes[2].row = row + 1
-        boxes[2].col = col
-        boxes[3].row = row + 1
-        boxes[3].col = col + 1
 
-    def get_top_box(self):
-        return self.boxes[0]
+class ServerSession:
 
-    def get_bottom_box(self):
-        return self.boxes[3]
+    def __init__(self, writer, level, seed, rows=None, cols=None,
+                 pieces_file=None):
+        self.writer = writer
+        self.level = level
+        self.board = create_board(
+            lambda: self.level, seed, pieces_file=pieces_file, rows=rows,
+            cols=cols)
+        self.board.add_listener(EVENT_FULL_LINES, self.on_full_lines)
+        self.scores = 0
+        self.lines = 0
+        self.tick = 0
+        self.cells = None
+        self.version = None
+        self.palette_size = 0
+        self.pose = None
 
-    def get_left_box(self):
-        return self.boxes[2]
+    def on_full_lines(self, count):
+        self.lines += count
+        self.scores += self.level * count
 
-    def get_right_box(self):
-        return self.boxes[3]
+    def on_input(self, code):
+        if code != REPLAY_INPUT_CODES['REWIND']:
+            apply_input_code(self.board, code)
 
-    def get_bottom_boxes(self):
-        return [self.boxes[2], self.boxes[3]]
+    def update(self, delta_time):
+        self.board.update(delta_time)
+        self.tick += 1
+        if self.writer.transport.get_write_buffer_size() > SERVER_MAX_BUFFER:
+            # Wolny klient dostanie pełny stan, gdy nadrobi zaległości.
+            self.cells = None
+            return
+        if self.cells is None:
+            self.send_full()
+        else:
+            self.send_delta()
+
+    def get_cells(self):
+        static_boxes = self.board.static_boxes
+        if static_boxes.version != self.version:
+            self.version = static_boxes.version
+            return static_boxes.pack_cells(self.board.get_color_index)
+        return self.cells
+
+    def send_full(self):
+        board = self.board
+        self.cells = self.get_cells()
+        self.palette_size = len(board.palette)
+        payload = b''.join([
+            MESSAGE_FULL_HEAD.pack(
+                board.static_boxes.row_count, board.static_boxes.col_count,
+                self.palette_size - 1),
+            encode_palette(board.palette[1:]),
+            self.cells,
+        ])
+        self.writer.write(encode_message(MESSAGE_FULL, payload))
+        self.pose = None
+        self.send_delta()
+
+    def send_delta(self):
+        board = self.board
+        cells = self.get_cells()
+        changes = []
+        if cells is not self.cells:
+            cols = board.static_boxes.col_count
+            old_rows = dict(iter_packed_rows(self.cells, cols))
+            new_rows = dict(iter_packed_rows(cells, cols))
+            empty_row = bytes(cols)
+            for row in sorted(old_rows.keys() | new_rows.keys()):
+                old_colors = old_rows.get(row, empty_row)
+                colors = new_rows.get(row, empty_row)
+                if old_colors == colors:
+                    continue
+                for col in range(cols):
+                    if old_colors[col] != colors[col]:
+                        changes.append(MESSAGE_CELL.pack(
+                            row * cols + col, colors[col]))
+            self.cells = cells
+
+        block = board.curr_block
+        kind = rotation = 0
+        boxes = b''
+        if block is not None:
+            kind = ord(block.kind)
+            rotation = block.rotate_position
+            boxes = b''.join(
+                MESSAGE_BOX.pack(box.row, box.col) for box in block.boxes)
+        pose = (kind, rotation, boxes, self.scores, board.game_over)
+        new_palette = board.palette[self.palette_size:]
+        if not changes and not new_palette and pose == self.pose:
+            return
+        self.pose = pose
+        self.palette_size = len(board.palette)
+        payload = b''.join([
+            MESSAGE_DELTA_HEAD.pack(
+                self.tick, self.scores, self.lines, board.game_over, kind,
+                rotation, len(boxes) // MESSAGE_BOX.size, len(new_palette)),
+            encode_palette(new_palette),
+            boxes,
+            struct.pack('<I', len(changes)),
+        ] + changes)
+        self.writer.write(encode_message(MESSAGE_DELTA, payload))
+
+
+class BotView:
+
+    def __init__(self, board):
+        self.board = board
 
-    def rotate(self):
-        pass
+    @property
+    def grid(self):
+        return self.board.static_boxes.get_row_masks()
 
-    def make_rotated(self):
-        return self
+    @property
+    def piece(self):
+        block = self.board.curr_block
+        return None if block is None else block.kind
 
+    @property
+    def rotation(self):
+        block = self.board.curr_block
+        return 0 if block is None else block.rotate_position
 
-class UnitAccumulator:
+    @property
+    def col(self):
+        block = self.board.curr_block
+        if block is None:
+            return None
+        return min(box.col for box in block.boxes)
 
-    def __init__(self, unit):
-        self.real_value = 0
-        self.unit = unit
+    @property
+    def cells(self):
+        block = self.board.curr_block
+        if block is None:
+            return ()
+        return tuple((box.row, box.col) for box in block.boxes)
 
-    def inc(self, delta):
-        self.real_value += delta
+    @property
+    def next_piece(self):
+        block = self.board.next_block
+        return None if block is None else block.kind
 
-    def take_value(self):
-        value = self.real_value // self.unit
-        if value:
-            self.real_value -= value * self.unit
-        return int(value)
 
+class SearchBot:
 
-def create_board(get_level):
+    def __init__(self):
+        self.autoplayer = None
+        self.block = None
+        self.target = None
+
+    def __call__(self, view):
+        board = view.board
+        block = board.curr_block
+        if block is None:
+            return None
+        if self.autoplayer is None or self.autoplayer.board is not board:
+            self.autoplayer = AutoPlayer(board)
+        if block is not self.block:
+            self.block = block
+            self.target = self.autoplayer.plan(block)
+        if self.target is None:
+            return 'DROP'
+        rotate_position, col = self.target
+        if view.rotation != rotate_position:
+            return 'ROTATE'
+        if view.col < col:
+            return 'RIGHT'
+        if view.col > col:
+            return 'LEFT'
+        return 'DROP'
+
+
+class RandomBot:
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+
+    def __call__(self, view):
+        return self.random.choice(('LEFT', 'RIGHT', 'ROTATE', 'DROP', None))
+
+
+def drop_bot():
+    return lambda view: 'DROP'
+
+
+BOT_POLICIES = {
+    'search': SearchBot,
+    'random': RandomBot,
+    'drop': drop_bot,
+}
+
+TournamentResult = collections.namedtuple(
+    'TournamentResult',
+    ['bot', 'seed', 'pieces', 'lines', 'survival', 'duration'])
+
+
+def load_bot(spec):
+    if spec in BOT_POLICIES:
+        return BOT_POLICIES[spec]()
+    module_name, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), name)()
+
+
+def run_tournament_game(spec, seed, level, max_pieces, rows=None,
+                        cols=None, pieces_file=None):
+    policy = load_bot(spec)
+    env = TetrisEnv(
+        level, seed, rows=rows, cols=cols, pieces_file=pieces_file)
+    stats = {'pieces': 0}
+
+    def on_lock():
+        stats['pieces'] += 1
+
+    env.board.add_lock_listener(on_lock)
+    view = BotView(env.board)
+    steps = 0
+    done = False
+    start_time = time.perf_counter()
+    while not done and stats['pieces'] < max_pieces:
+        action = policy(view)
+        _, _, done, _ = env.step(
+            0 if action is None else ENV_ACTIONS.index(action))
+        steps += 1
+    duration = time.perf_counter() - start_time
+    return TournamentResult(
+        spec, seed, stats['pieces'], env.lines, steps * env.step_time,
+        duration)
+
+
+def run_tournament(specs, seeds, level=1, max_pieces=TOURNAMENT_MAX_PIECES,
+                   workers=None, rows=None, cols=None, pieces_file=None):
+    # Partie są deterministyczne, więc każdy bot gra każde ziarno raz,
+    # a pary porównuje się na wynikach z tych samych ziaren.
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(
+                run_tournament_game, spec, seed, level, max_pieces, rows,
+                cols, pieces_file)
+            for spec in specs for seed in seeds]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results[result.bot, result.seed] = result
+
+    table = dict(
+        (spec, {'bot': spec, 'wins': 0.0, 'pieces': 0, 'lines': 0,
+                'survival': 0.0, 'duration': 0.0})
+        for spec in specs)
+    for spec in specs:
+        row = table[spec]
+        for seed in seeds:
+            result = results[spec, seed]
+            row['pieces'] += result.pieces
+            row['lines'] += result.lines
+            row['survival'] += result.survival
+            row['duration'] += result.duration
+    for first, second in itertools.combinations(specs, 2):
+        for seed in seeds:
+            first_key = get_match_key(results[first, seed])
+            second_key = get_match_key(results[second, seed])
+            if first_key > second_key:
+                table[first]['wins'] += 1
+            elif second_key > first_key:
+                table[second]['wins'] += 1
+            else:
+                table[first]['wins'] += 0.5
+                table[second]['wins'] += 0.5
+    return sorted(
+        table.values(),
+        key=lambda row: (row['wins'], row['lines'], row['survival']),
+        reverse=True)
+
+
+def get_match_key(result):
+    return result.lines, result.survival
+
+
+def print_tournament(rows, seed_count):
+    print('{:<4}{:<24}{:>9}{:>9}{:>11}{:>12}'.format(
+        'NR', 'BOT', 'WYGRANE', 'LINIE', 'KLOCKI/S', 'CZAS GRY'))
+    for place, row in enumerate(rows, 1):
+        print('{:<4}{:<24}{:>9g}{:>9}{:>11.1f}{:>11.1f}s'.format(
+            place, row['bot'], row['wins'], row['lines'],
+            row['pieces'] / max(row['duration'], 1e-9),
+            row['survival'] / seed_count))
+
+
+class GameServer:
+
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, level=1,
+                 tick_rate=SERVER_TICK_RATE, rows=None, cols=None,
+                 pieces_file=None):
+        self.host = host
+        self.port = port
+        self.level = level
+        self.rows = rows
+        self.cols = cols
+        self.pieces_file = pieces_file
+        self.tick_rate = tick_rate
+        self.tick_time = 1.0 / tick_rate
+        self.sessions = set()
+        self.server = None
+        self.ticks = 0
+        self.busy_time = 0.0
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.on_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve(self):
+        await self.start()
+        print('SERWER NA PORCIE {}'.format(self.port))
+        async with self.server:
+            await self.run_ticks()
+
+    async def on_client(self, reader, writer):
+        session = ServerSession(
+            writer, self.level, random.randrange(1 << 32), self.rows,
+            self.cols, self.pieces_file)
+        self.sessions.add(session)
+        try:
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == MESSAGE_INPUT:
+                    for code in payload:
+                        session.on_input(code)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    async def run_ticks(self):
+        loop = asyncio.get_running_loop()
+        next_time = loop.time()
+        while True:
+            start_time = time.perf_counter()
+            for session in list(self.sessions):
+                session.update(self.tick_time)
+            self.busy_time += time.perf_counter() - start_time
+            self.ticks += 1
+            if self.ticks % (self.tick_rate * 10) == 0:
+                print(self.report())
+            next_time += self.tick_time
+            delay = next_time - loop.time()
+            if delay < -self.tick_time:
+                # Serwer nie nadąża, nie nadrabiamy zaległych taktów.
+                next_time = loop.time()
+            await asyncio.sleep(max(delay, 0))
+
+    def report(self):
+        return 'GRY: {}, CZAS TAKTU: {:.2f} MS'.format(
+            len(self.sessions), 1000 * self.busy_time / max(self.ticks, 1))
+
+
+class ClientBoard:
+
+    def __init__(self):
+        self.rows = self.cols = 0
+        self.cells = bytearray()
+        self.palette = [None]
+        self.tick = 0
+        self.scores = 0
+        self.lines = 0
+        self.game_over = False
+        self.kind = None
+        self.rotation = 0
+        self.boxes = []
+
+    def apply(self, kind, payload):
+        if kind == MESSAGE_FULL:
+            self.apply_full(payload)
+        elif kind == MESSAGE_DELTA:
+            self.apply_delta(payload)
+
+    def apply_full(self, payload):
+        self.rows, self.cols, count = MESSAGE_FULL_HEAD.unpack_from(payload)
+        offset = MESSAGE_FULL_HEAD.size
+        self.palette = [None] + decode_palette(payload[offset:], count)
+        offset += count * 3
+        self.cells = bytearray(self.rows * self.cols)
+        for row, colors in iter_packed_rows(payload[offset:], self.cols):
+            self.cells[row * self.cols:(row + 1) * self.cols] = colors
+
+    def apply_delta(self, payload):
+        (self.tick, self.scores, self.lines, game_over, kind, self.rotation,
+         box_count, palette_count) = MESSAGE_DELTA_HEAD.unpack_from(payload)
+        self.game_over = bool(game_over)
+        self.kind = chr(kind) if kind else None
+        offset = MESSAGE_DELTA_HEAD.size
+        self.palette.extend(decode_palette(payload[offset:], palette_count))
+        offset += palette_count * 3
+        self.boxes = list(MESSAGE_BOX.iter_unpack(
+            payload[offset:offset + box_count * MESSAGE_BOX.size]))
+        offset += box_count * MESSAGE_BOX.size
+        count, = struct.unpack_from('<I', payload, offset)
+        offset += 4
+        for index, value in MESSAGE_CELL.iter_unpack(
+                payload[offset:offset + count * MESSAGE_CELL.size]):
+            self.cells[index] = value
+
+
+async def run_bot_client(host, port, duration, stats):
+    reader, writer = await asyncio.open_connection(host, port)
+    board = ClientBoard()
+    codes = [REPLAY_INPUT_CODES[name] for name in
+             ('SHIFT_LEFT', 'SHIFT_RIGHT', 'ROTATE', 'DROP')]
+    loop = asyncio.get_running_loop()
+    end_time = loop.time() + duration
+    next_input = loop.time()
+    try:
+        while loop.time() < end_time:
+            try:
+                kind, payload = await asyncio.wait_for(
+                    read_message(reader), end_time - loop.time())
+            except asyncio.TimeoutError:
+                break
+            stats['messages'] += 1
+            stats['bytes'] += MESSAGE_HEADER.size + len(payload)
+            board.apply(kind, payload)
+            if loop.time() >= next_input and not board.game_over:
+                next_input = loop.time() + 0.1
+                writer.write(encode_message(
+                    MESSAGE_INPUT, bytes([random.choice(codes)])))
+    finally:
+        writer.close()
+    stats['lines'] += board.lines
+    return board
+
+
+async def run_bot_clients(host, port, count, duration):
+    stats = {'messages': 0, 'bytes': 0, 'lines': 0}
+    await asyncio.gather(*[
+        run_bot_client(host, port, duration, stats) for _ in range(count)])
+    print('KLIENCI: {}, WIADOMOŚCI: {}, BAJTY: {}, LINIE: {}'.format(
+        count, stats['messages'], stats['bytes'], stats['lines']))
+
+
+def create_board(get_level, seed=None, geometry=BOARD_GEOMETRY,
+                 pieces_file=None, rows=None, cols=None):
+    shapes = load_piece_shapes(pieces_file or PIECES_FILE)
     return Board(
         block_factories=[
-            BlockFactory(
-                BigBlock,
-                COLOR_BIG_BLOCK,
-                BOX_SIZE,
-                get_gravity,
-                PLAYER_SPEED
-            ),
-            BlockFactory(
-                LongBlock,
-                COLOR_LONG_BLOCK,
-                BOX_SIZE,
-                get_gravity,
-                PLAYER_SPEED
-            ),
-            BlockFactory(
-                TBlock,
-                COLOR_T_BLOCK,
-                BOX_SIZE,
-                get_gravity,
-                PLAYER_SPEED
-            ),
-            BlockFactory(
-                LBlock,
-                COLOR_L_BLOCK,
-                BOX_SIZE,
-                get_gravity,
-                PLAYER_SPEED
-            ),
-            BlockFactory(
-                SBlock,
-                COLOR_S_BLOCK,
-                BOX_SIZE,
-                get_gravity,
-                PLAYER_SPEED
-            ),
-            BlockFactory(
-                ZBlock,
-                COLOR_Z_BLOCK,
-                BOX_SIZE,
-                get_gravity,
-                PLAYER_SPEED
-            ),
+            BlockFactory(shape, BOX_SIZE, get_gravity, PLAYER_SPEED)
+            for shape in shapes
         ],
-        get_level=get_level
+        get_level=get_level,
+        seed=seed,
+        geometry=geometry,
+        rows=rows,
+        cols=cols
     )
 
 
+def run_headless(pieces, level, seed, record=None, pieces_path=None,
+                 rows=None, cols=None, pieces_file=None):
+    stats = {'lines': 0}
+
+    def on_full_lines(count):
+        stats['lines'] += count
+
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    board = create_board(
+        lambda: level, seed, pieces_file=pieces_file, rows=rows, cols=cols)
+    board.add_listener(EVENT_FULL_LINES, on_full_lines)
+    recorder = None
+    if record is not None:
+        recorder = ReplayRecorder(
+            board, seed, level,
+            lambda: (level * stats['lines'], stats['lines']))
+    piece_recorder = None
+    if pieces_path is not None:
+        piece_recorder = PieceRecorder(
+            board, random.getrandbits(64),
+            lambda: (level * stats['lines'], stats['lines']))
+    player = AutoPlayer(board)
+    start_time = time.perf_counter()
+    played = player.play_headless(pieces)
+    duration = time.perf_counter() - start_time
+    print('KLOCKI: {}, LINIE: {}, GAME OVER: {}, {:.1f} KLOCKÓW/S'.format(
+        played, stats['lines'], board.game_over, played / duration))
+    if recorder is not None:
+        write_bytes_atomic(record, recorder.to_bytes())
+    if piece_recorder is not None:
+        PieceStore(pieces_path).append(piece_recorder.take_records())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Tetris')
+    parser.add_argument(
+        '--async', dest='use_asyncio', action='store_true',
+        help='run the main loop on an asyncio event loop')
+    parser.add_argument(
+        '--autoplay', action='store_true',
+        help='let the built-in AI play')
+    parser.add_argument(
+        '--headless', type=int, metavar='PIECES',
+        help='let the AI play PIECES pieces without a window and exit')
+    parser.add_argument(
+        '--level', type=int, default=1, help='level for --headless')
+    parser.add_argument(
+        '--seed', type=int, default=None, help='random seed for --headless')
+    parser.add_argument(
+        '--record', metavar='FILE', help='save a --headless game as a replay')
+    parser.add_argument(
+        '--replay', metavar='FILE', help='watch a recorded replay')
+    parser.add_argument(
+        '--pieces', metavar='FILE',
+        help='append the pieces of a --headless game to a piece store')
+    parser.add_argument(
+        '--stats', metavar='FILE', help='summarize a piece store and exit')
+    parser.add_argument(
+        '--players', type=int, choices=range(2, len(PLAYER_KEYS) + 1),
+        help='local split-screen game for 2-{} players'.format(
+            len(PLAYER_KEYS)))
+    parser.add_argument(
+        '--tournament', nargs='+', metavar='BOT',
+        help='rank bots ({} or module:factory) on shared seeds'.format(
+            ', '.join(sorted(BOT_POLICIES))))
+    parser.add_argument(
+        '--games', type=int, default=TOURNAMENT_SEEDS,
+        help='seeds played by every --tournament bot')
+    parser.add_argument(
+        '--max-pieces', type=int, default=TOURNAMENT_MAX_PIECES,
+        help='piece limit of a --tournament game')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='processes used by --tournament')
+    parser.add_argument(
+        '--piece-set', metavar='FILE', default=PIECES_FILE,
+        help='JSON file with the piece definitions')
+    parser.add_argument(
+        '--rows', type=int, default=BOARD_ROWS,
+        help='board height in cells (up to {})'.format(BOARD_MAX_ROWS))
+    parser.add_argument(
+        '--cols', type=int, default=BOARD_COLS,
+        help='board width in cells (up to {})'.format(BOARD_MAX_COLS))
+    parser.add_argument(
+        '--server', type=int, nargs='?', const=SERVER_PORT, metavar='PORT',
+        help='host network games on PORT')
+    parser.add_argument(
+        '--bots', type=int, nargs='?', const=1, metavar='COUNT',
+        help='connect COUNT stand-in clients to a server and exit')
+    parser.add_argument(
+        '--host', default=SERVER_HOST, help='server address for --bots')
+    parser.add_argument(
+        '--port', type=int, default=SERVER_PORT,
+        help='server port for --bots')
+    parser.add_argument(
+        '--duration', type=float, default=10.0,
+        help='how many seconds --bots play')
+    parser.add_argument(
+        '--spectate', action='store_true',
+        help='print the live board feed of a running game')
+    parser.add_argument(
+        '--speed', type=float, default=1.0, help='playback speed for --replay')
+    args = parser.parse_args()
+    if not 4 <= args.rows <= BOARD_MAX_ROWS:
+        parser.error('--rows must be between 4 and {}'.format(BOARD_MAX_ROWS))
+    if not 4 <= args.cols <= BOARD_MAX_COLS:
+        parser.error('--cols must be between 4 and {}'.format(BOARD_MAX_COLS))
+    return args
+
+
 if __name__ == '__main__':
-    container = ActivityContainer(WINDOW_WIDTH, WINDOW_HEIGHT, 'Tetris')
-    container.run_activity(TetrisActivity())
+    args = parse_args()
+    board_options = {
+        'rows': args.rows,
+        'cols': args.cols,
+        'pieces_file': args.piece_set,
+    }
+    if args.headless is not None:
+        run_headless(
+            args.headless, args.level, args.seed, args.record, args.pieces,
+            **board_options)
+        sys.exit(0)
+    if args.stats is not None:
+        print_piece_stats(args.stats)
+        sys.exit(0)
+    if args.tournament is not None:
+        base_seed = args.seed if args.seed is not None else 0
+        seeds = [base_seed + index for index in range(args.games)]
+        print_tournament(
+            run_tournament(
+                args.tournament, seeds, args.level, args.max_pieces,
+                args.workers, **board_options),
+            len(seeds))
+        sys.exit(0)
+    if args.spectate:
+        run_spectator(FEED_NAME)
+        sys.exit(0)
+    if args.bots is not None:
+        asyncio.run(run_bot_clients(
+            args.host, args.port, args.bots, args.duration))
+        sys.exit(0)
+    if args.server is not None:
+        asyncio.run(GameServer(
+            port=args.server, level=args.level, **board_options).serve())
+        sys.exit(0)
+    if args.players is not None:
+        container = ActivityContainer(
+            args.players * PLAYER_WIDTH, WINDOW_HEIGHT, 'Tetris')
+        activity = SplitScreenActivity(
+            args.players, args.level, args.seed, **board_options)
+    elif args.replay is not None:
+        container = ActivityContainer(WINDOW_WIDTH, WINDOW_HEIGHT, 'Tetris')
+        activity = ReplayViewer(
+            ReplayArchive.load(args.replay), args.speed, args.piece_set)
+    else:
+        container = ActivityContainer(WINDOW_WIDTH, WINDOW_HEIGHT, 'Tetris')
+        activity = TetrisActivity(args.autoplay, **board_options)
+    if args.use_asyncio:
+        asyncio.run(container.run_activity_async(activity))
+    else:
+        container.run_activity(activity)
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def in_game_dir(monkeypatch):
+    # Gra wczytuje pieces.json i dźwięki ze ścieżek względnych.
+    monkeypatch.chdir(ROOT)
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+pytest.importorskip('pygame')
+
+import game  # noqa: E402
+
+
+def get_dense_cells(board):
+    static_boxes = board.static_boxes
+    cols = static_boxes.col_count
+    cells = bytearray(static_boxes.row_count * cols)
+    for box in static_boxes.boxes:
+        if box.row >= 0:
+            cells[box.row * cols + box.col] = board.get_color_index(
+                box.color)
+    return bytes(cells)
+
+
+@pytest.fixture
+def feed_name():
+    return 'tetris_test_{}'.format(os.getpid())
+
+
+def keep_registered(memory):
+    # Czytelnik wyrejestrowuje segment, a tu właścicielem jest ten sam
+    # proces, który na końcu usuwa segment.
+    game.resource_tracker.register(memory._name, 'shared_memory')
+
+
+def test_reader_sees_published_board(feed_name):
+    activity = game.PlayActivity()
+    activity.seed = 11
+    activity.autoplay = True
+    activity.recording = False
+    activity.prepare()
+    rows, cols = activity.get_board_shape()
+    feed = game.BoardFeed(feed_name, rows, cols)
+    try:
+        activity.enable_feed(feed)
+        reader = game.BoardFeedReader(feed_name)
+        keep_registered(feed.memory)
+        try:
+            assert (reader.rows, reader.cols) == (rows, cols)
+            for _ in range(3000):
+                activity.update(1 / 60)
+                board = activity.board
+                state = reader.read()
+                assert state.frame == feed.frame
+                assert (state.scores, state.lines, state.level) == (
+                    activity.scores, activity.lines, activity.level)
+                assert state.game_over == board.game_over
+                assert state.cells == get_dense_cells(board)
+                block = board.curr_block
+                if block is None:
+                    assert state.kind is None
+                    assert state.boxes == []
+                else:
+                    assert state.kind == block.kind
+                    assert state.rotation == block.rotate_position
+                    assert state.boxes == [
+                        (box.row, box.col) for box in block.boxes]
+                if board.game_over:
+                    break
+            assert activity.lines > 0
+        finally:
+            reader.close()
+    finally:
+        feed.close()
+
+
+def test_reader_rejects_other_segment(feed_name):
+    memory = game.shared_memory.SharedMemory(
+        feed_name, create=True, size=game.FEED_HEADER.size)
+    try:
+        with pytest.raises(ValueError):
+            game.BoardFeedReader(feed_name)
+        keep_registered(memory)
+    finally:
+        memory.close()
+        memory.unlink()
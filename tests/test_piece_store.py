@@ -0,0 +1,122 @@
+import random
+
+import pytest
+
+pytest.importorskip('pygame')
+
+import game  # noqa: E402
+
+
+def make_records(seed, count):
+    values = random.Random(seed)
+    return [
+        game.PieceRecord(
+            values.getrandbits(64), values.randrange(1 << 32),
+            values.randrange(1 << 32), ord(values.choice('IJLOSTZ')),
+            values.randrange(4), values.randrange(-3, 200),
+            values.randrange(5))
+        for _ in range(count)]
+
+
+def pack_records(records):
+    return b''.join(game.PIECE_RECORD.pack(*record) for record in records)
+
+
+def test_records_round_trip(tmp_path):
+    store = game.PieceStore(str(tmp_path / 'pieces.bin'))
+    first = make_records(1, 10)
+    second = make_records(2, 7)
+    store.append(pack_records(first))
+    store.append(pack_records(second))
+    assert list(store.iter_records(chunk_size=3)) == first + second
+
+
+def test_partial_record_is_skipped(tmp_path):
+    path = tmp_path / 'pieces.bin'
+    store = game.PieceStore(str(path))
+    records = make_records(3, 5)
+    store.append(pack_records(records))
+    with open(str(path), 'ab') as document:
+        document.write(pack_records(make_records(4, 1))[:7])
+    assert list(store.iter_records()) == records
+
+
+def test_summary_counts_records(tmp_path):
+    store = game.PieceStore(str(tmp_path / 'pieces.bin'))
+    records = make_records(5, 50)
+    store.append(pack_records(records))
+    stats = store.summarize(chunk_size=8)
+    assert stats['pieces'] == 50
+    assert stats['lines'] == sum(record.lines for record in records)
+    assert stats['games'] == len(set(record.game_id for record in records))
+    assert sum(stats['kinds'].values()) == 50
+
+
+def test_empty_store(tmp_path):
+    path = tmp_path / 'pieces.bin'
+    path.write_bytes(b'')
+    assert list(game.PieceStore(str(path)).iter_records()) == []
+
+
+def test_foreign_file_is_rejected(tmp_path):
+    path = tmp_path / 'pieces.bin'
+    path.write_bytes(b'NOPE' + bytes(game.PIECE_STORE_HEADER.size))
+    with pytest.raises(ValueError):
+        list(game.PieceStore(str(path)).iter_records())
+
+
+def test_recorder_writes_one_record_per_piece(tmp_path):
+    board = game.create_board(lambda: 1, 7)
+    scores = {'lines': 0}
+
+    def on_full_lines(count):
+        scores['lines'] += count
+
+    board.add_listener(game.EVENT_FULL_LINES, on_full_lines)
+    recorder = game.PieceRecorder(
+        board, 99, lambda: (scores['lines'], scores['lines']))
+    locks = []
+    board.add_lock_listener(lambda: locks.append(board.locked_block.kind))
+    game.AutoPlayer(board).play_headless(60)
+    store = game.PieceStore(str(tmp_path / 'pieces.bin'))
+    store.append(recorder.take_records())
+    records = list(store.iter_records())
+    assert [chr(record.kind) for record in records] == locks
+    assert sum(record.lines for record in records) == scores['lines']
+    assert set(record.game_id for record in records) == {99}
+
+
+def create_activity(seed):
+    activity = game.PlayActivity()
+    activity.seed = seed
+    activity.autoplay = True
+    activity.prepare()
+    batches = []
+    activity.add_listener('PIECES', batches.append)
+    return activity, batches
+
+
+def test_activity_flushes_records_before_game_over(monkeypatch):
+    monkeypatch.setattr(game, 'PIECE_FLUSH_RECORDS', 8)
+    activity, batches = create_activity(11)
+    while len(batches) < 3 and not activity.board.game_over:
+        activity.update(1 / 60)
+    batch_size = 8 * game.PIECE_RECORD.size
+    assert [len(batch) for batch in batches] == [batch_size] * 3
+
+
+def test_load_starts_new_piece_recording():
+    activity, batches = create_activity(12)
+    locks = []
+    activity.board.add_lock_listener(lambda: locks.append(1))
+    while len(locks) < 5:
+        activity.update(1 / 60)
+    first_recorder = activity.piece_recorder
+    activity.set_state(activity.get_state())
+    assert len(batches) == 1
+    assert len(batches[0]) == 5 * game.PIECE_RECORD.size
+    assert activity.piece_recorder is not first_recorder
+    while len(locks) < 8:
+        activity.update(1 / 60)
+    assert first_recorder.record_count() == 0
+    assert activity.take_piece_records()
@@ -0,0 +1,128 @@
+import functools
+import random
+
+import pytest
+
+pytest.importorskip('pygame')
+
+import game  # noqa: E402
+
+TICKS = 4000
+
+
+def get_state(activity):
+    return activity.board.get_zobrist(), activity.scores, activity.lines
+
+
+@functools.lru_cache()
+def play_live(seed):
+    activity = game.PlayActivity()
+    activity.seed = seed
+    activity.autoplay = True
+    activity.prepare()
+    board = activity.board
+    inputs = random.Random(seed)
+    history = []
+    for tick in range(TICKS):
+        history.append(get_state(activity))
+        action = inputs.random()
+        if action < 0.02:
+            board.rotate_curr_block()
+        elif action < 0.04:
+            board.set_direction(inputs.choice(['LEFT', 'RIGHT', None]))
+        elif tick % 1000 in (500, 560):
+            board.toggle_pause()
+        activity.update(inputs.choice((1 / 60, 1 / 30)))
+        if board.game_over:
+            break
+    history.append(get_state(activity))
+    return game.ReplayArchive(activity.recorder.to_bytes()), history
+
+
+@pytest.mark.parametrize('seed', [1, 2])
+def test_replay_matches_live_game(seed):
+    archive, history = play_live(seed)
+    player = game.ReplayPlayer(archive)
+    while not player.is_finished():
+        assert get_state(player.play_activity) == history[player.tick]
+        player.step()
+    assert player.tick == len(history) - 1
+    assert get_state(player.play_activity) == history[-1]
+
+
+def test_seek_matches_live_game():
+    archive, history = play_live(1)
+    player = game.ReplayPlayer(archive)
+    for tick in (len(history) - 2, 0, 1234, 777, len(history) // 2):
+        player.seek(tick)
+        assert player.tick == tick
+        assert get_state(player.play_activity) == history[tick]
+
+
+def test_fast_forward_reaches_live_end():
+    archive, history = play_live(2)
+    player = game.ReplayPlayer(archive)
+    player.advance(1e9)
+    assert player.is_finished()
+    assert get_state(player.play_activity) == history[-1]
+
+
+def test_rewind_followed_by_lock_without_input():
+    # Klatka kluczowa po położeniu klocka ma ten sam numer wejścia co
+    # klatka cofnięcia, a odtwarzanie musi wybrać tę drugą.
+    activity = game.PlayActivity()
+    activity.seed = 5
+    activity.prepare()
+    activity.recorder.keyframe_interval = 1
+    locks = []
+    activity.board.add_lock_listener(lambda: locks.append(True))
+    history = []
+    rewound = False
+    while len(locks) < 8 and not activity.board.game_over:
+        history.append(get_state(activity))
+        if len(locks) == 4 and not rewound:
+            activity.rewind()
+            rewound = True
+            rewind_tick = len(history) - 1
+        activity.update(1 / 60)
+    history.append(get_state(activity))
+    archive = game.ReplayArchive(activity.recorder.to_bytes())
+    input_indexes = [entry[2] for entry in archive.index]
+    assert len(input_indexes) > len(set(input_indexes))
+    player = game.ReplayPlayer(archive)
+    while not player.is_finished():
+        assert get_state(player.play_activity) == history[player.tick]
+        player.step()
+    assert get_state(player.play_activity) == history[-1]
+    for tick in (rewind_tick, rewind_tick + 1, len(history) - 2):
+        player.seek(tick)
+        assert get_state(player.play_activity) == history[tick]
+
+
+def test_load_starts_new_recording():
+    activity = game.PlayActivity()
+    activity.seed = 6
+    activity.autoplay = True
+    activity.prepare()
+    locks = []
+    activity.board.add_lock_listener(lambda: locks.append(True))
+    while len(locks) < 3:
+        activity.update(1 / 60)
+    activity.update(1 / 60)
+    state = activity.get_state()
+    assert state['board']['curr_block'] is not None
+    while len(locks) < 6:
+        activity.update(1 / 60)
+    activity.set_state(state)
+    assert activity.recorder is None
+    history = []
+    while len(locks) < 20 and not activity.board.game_over:
+        activity.update(1 / 60)
+        if activity.recorder is not None:
+            history.append(get_state(activity))
+    archive = game.ReplayArchive(activity.recorder.to_bytes())
+    player = game.ReplayPlayer(archive)
+    while not player.is_finished():
+        player.step()
+        assert get_state(player.play_activity) == history[player.tick - 1]
+    assert player.tick == len(history)
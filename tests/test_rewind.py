@@ -0,0 +1,101 @@
+import pytest
+
+pytest.importorskip('pygame')
+
+import game  # noqa: E402
+
+LOCKS = 40
+REWINDS = 12
+
+
+def get_static_state(board):
+    static_boxes = board.static_boxes
+    return (
+        static_boxes.zobrist,
+        vars(static_boxes.features.copy()),
+        sorted((box.row, box.col) for box in static_boxes.boxes),
+    )
+
+
+def rebuild(board):
+    # Hasz i cechy liczone od zera z samych pól planszy.
+    static_boxes = board.static_boxes
+    fresh = game.StaticBoxGroup(static_boxes.row_count, static_boxes.col_count)
+    fresh.set_boxes([
+        game.Box(box.row, box.col, box.color, board)
+        for box in static_boxes.boxes])
+    return fresh.zobrist, vars(fresh.features)
+
+
+def play(activity, locks):
+    states = []
+
+    def on_lock():
+        states.append(get_static_state(activity.board))
+
+    activity.board.add_lock_listener(on_lock)
+    while len(states) < locks and not activity.board.game_over:
+        activity.update(1 / 60)
+    return states
+
+
+def create_activity(seed, autoplay=True):
+    activity = game.PlayActivity()
+    activity.seed = seed
+    activity.autoplay = autoplay
+    activity.recording = False
+    activity.prepare()
+    return activity
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_rewind_restores_hash_and_features(seed):
+    activity = create_activity(seed)
+    states = play(activity, LOCKS)
+    assert len(states) == LOCKS
+    assert sum(box.row >= 0 for box in activity.board.static_boxes.boxes)
+    for step in range(1, REWINDS + 1):
+        activity.rewind()
+        board = activity.board
+        assert get_static_state(board) == states[-1 - step]
+        assert board.get_zobrist() == board.static_boxes.zobrist
+        assert rebuild(board) == get_static_state(board)[:2]
+
+
+def test_play_after_rewind_keeps_incremental_state():
+    activity = create_activity(4)
+    play(activity, LOCKS)
+    for _ in range(REWINDS):
+        activity.rewind()
+    mismatches = []
+
+    def on_lock():
+        board = activity.board
+        if rebuild(board) != get_static_state(board)[:2]:
+            mismatches.append(len(board.static_boxes.boxes))
+
+    activity.board.add_lock_listener(on_lock)
+    play(activity, LOCKS)
+    assert mismatches == []
+    assert activity.lines > 0
+
+
+def test_rewind_before_first_lock_keeps_next_block():
+    activity = create_activity(5, autoplay=False)
+    fresh = create_activity(5, autoplay=False)
+    next_kind = activity.board.next_block.kind
+    for _ in range(30):
+        activity.update(1 / 60)
+    activity.board.toggle_pause()
+    activity.rewind()
+    activity.board.toggle_pause()
+    assert activity.board.next_block is not None
+    assert activity.board.next_block.kind == next_kind
+    kinds = []
+    fresh_kinds = []
+    for _ in range(300):
+        activity.update(1 / 60)
+        fresh.update(1 / 60)
+        kinds.append(activity.board.next_block.kind)
+        fresh_kinds.append(fresh.board.next_block.kind)
+    assert kinds == fresh_kinds
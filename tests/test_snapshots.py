@@ -0,0 +1,94 @@
+import pytest
+
+pytest.importorskip('pygame')
+
+import game  # noqa: E402
+
+
+class RecordingPainter(game.Painter):
+
+    def __init__(self, width=game.WINDOW_WIDTH, height=game.WINDOW_HEIGHT):
+        super().__init__(width, height)
+        self.texts = []
+        self.cells = 0
+
+    def fill_rect(self, x, y, w, h, color):
+        self.cells += 1
+
+    def draw_rect(self, x, y, w, h, color):
+        pass
+
+    def draw_line(self, x1, y1, x2, y2, color):
+        pass
+
+    def draw_text(self, x, y, text, color):
+        self.texts.append(text)
+
+    def blit(self, surface, x, y, area=None):
+        pass
+
+    def set_clip(self, x, y, w, h):
+        pass
+
+    def reset_clip(self):
+        pass
+
+    def create_layer(self, x, y, width, height):
+        layer = RecordingPainter(width, height)
+        layer.screen = None
+        layer.render = lambda painter, area=None: None
+        return layer
+
+
+def create_activity():
+    activity = game.PlayActivity()
+    activity.seed = 3
+    activity.autoplay = True
+    activity.recording = False
+    activity.prepare()
+    activity.enable_animations()
+    activity.enable_snapshots()
+    return activity
+
+
+def play_until_animation(activity):
+    for _ in range(5000):
+        activity.update(1 / 60)
+        if activity.board.read_snapshot().animations is not None:
+            return
+    pytest.fail('no animation started')
+
+
+def test_render_reads_only_the_snapshot():
+    activity = create_activity()
+    play_until_animation(activity)
+    board = activity.board
+    snapshot = board.read_snapshot()
+    level, scores = snapshot.counters
+    # Symulacja w innym wątku może być w połowie zmiany stanu planszy.
+    board.next_block = None
+    board.curr_block = None
+    board.static_boxes.rows = {}
+    board.static_boxes.boxes = []
+    board.animations.kinds[:] = bytes(board.animations.slots)
+    activity.scores = scores + 100
+    painter = RecordingPainter()
+    activity.render(painter)
+    assert 'PUNKTY: {}'.format(scores) in painter.texts
+    assert 'POZIOM: {}'.format(level) in painter.texts
+    assert painter.cells > 0
+
+
+def test_snapshot_follows_the_game():
+    activity = create_activity()
+    play_until_animation(activity)
+    for _ in range(600):
+        activity.update(1 / 60)
+        snapshot = activity.board.read_snapshot()
+        board = activity.board
+        assert snapshot.counters == (activity.level, activity.scores)
+        assert snapshot.next_cells == board.get_next_cells()
+        assert snapshot.origin == board.camera.get_origin()
+        assert (snapshot.animations is None) == (
+            not board.animations.active)
+    assert activity.lines > 0